@@ -0,0 +1,77 @@
+import hashlib
+import threading
+import numpy as np
+import scipy.sparse as sp
+from collections import OrderedDict
+import Config
+
+def arrayFingerprint(arrays):
+    # Content hash of a list of arrays, used as the identity of a dataset
+    m = hashlib.blake2b(digest_size=16)
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        m.update(str((a.dtype.str,a.shape)).encode())
+        m.update(a.view(np.uint8).reshape(-1))
+    return m.hexdigest()
+
+def arrayBytes(value):
+    if isinstance(value,np.ndarray):
+        return value.nbytes
+    if sp.issparse(value):
+        value = value.tocsr()
+        return value.data.nbytes+value.indices.nbytes+value.indptr.nbytes
+    if isinstance(value,(tuple,list)):
+        return sum(arrayBytes(v) for v in value)
+    return 0
+
+class LRUCache(object):
+    # Least recently used entries are evicted once the estimated size of
+    # the cached values exceeds maxBytes. Safe to share between threads
+    def __init__(self, maxBytes:int):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if (key not in self.entries):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def put(self, key, value, nbytes:int = None):
+        if (nbytes == None):
+            nbytes = arrayBytes(value)
+        with self.lock:
+            if (key in self.entries):
+                self.size -= self.entries.pop(key)[1]
+            if (nbytes > self.maxBytes):
+                return value
+            self.entries[key] = (value,nbytes)
+            self.size += nbytes
+            while (self.size > self.maxBytes):
+                _,(_,evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+# Process-wide cache of grids and gridded databases
+gridCache = LRUCache(Config.GRID_CACHE_BYTES)
+# Process-wide cache of Markov matrix powers, shared by users with equal models
+markovCache = LRUCache(Config.MARKOV_CACHE_BYTES)
+# Process-wide cache of per-user synthesis models
+modelCache = LRUCache(Config.MODEL_CACHE_BYTES)
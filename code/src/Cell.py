@@ -3,9 +3,38 @@
 
 import random
 import math
+import numpy as np
 
+import Config
 from Point import Point
 
+def countTrajectoriesPerSubcell(subcells, owners, subcellCount):
+    # Number of distinct trajectories with at least one point in each subcell
+    if (len(subcells) == 0):
+        return np.zeros(subcellCount,dtype=np.int64)
+    pairs = np.unique(np.asarray(owners,dtype=np.int64)*subcellCount+subcells)
+    return np.bincount(pairs%subcellCount,minlength=subcellCount)
+
+def buildAliasTable(probs):
+    # Vose's alias method: column k keeps itself with aliasProb[k], else aliasIndex[k]
+    n = len(probs)
+    scaled = np.asarray(probs,dtype=np.float64)*n/np.sum(probs)
+    aliasProb = np.ones(n)
+    aliasIndex = np.arange(n)
+    small = [k for k in range(n) if scaled[k] < 1.0]
+    large = [k for k in range(n) if scaled[k] >= 1.0]
+    while (small and large):
+        s = small.pop()
+        l = large.pop()
+        aliasProb[s] = scaled[s]
+        aliasIndex[s] = l
+        scaled[l] = scaled[l]+scaled[s]-1.0
+        if (scaled[l] < 1.0):
+            small.append(l)
+        else:
+            large.append(l)
+    return aliasProb,aliasIndex
+
 class Cell(object):
     def __init__(self,minx,miny,xIncrement,yIncrement,nm):
         self.minX = minx
@@ -15,6 +44,8 @@ class Cell(object):
         self.name = nm
         self.leve2cells = []
         self.leve2densities = []
+        self.aliasProb = None
+        self.aliasIndex = None
 
     def __eq__(self,item):
         if isinstance(item,self.__class__):
@@ -43,47 +74,75 @@ class Cell(object):
         return self.name
 
     def sampleRandomPoint(self,time):
-        if (len(self.leve2cells) == 0 or len(self.leve2cells) == 1):
-            xcoord = self.minX + random.uniform(0,1)*(self.maxX-self.minX)
-            ycoord = self.minY + random.uniform(0,1)*(self.maxY-self.minY)
-            return Point(time,xcoord,ycoord)
-        else:
-            rand = random.uniform(0,1)
-            seenSoFar = 0.0
-            for i in range(len(self.leve2densities)):
-                seenSoFar = seenSoFar + self.leve2densities[i]
-                if (seenSoFar >= rand):
-                    myAdaptiveCell = self.leve2cells[i]
-                    xcoord = self.minX + random.uniform(0,1)*(self.maxX-self.minX)
-                    ycoord = self.minY + random.uniform(0,1)*(self.maxY-self.minY)
-                    return Point(time,xcoord,ycoord)
-            xcoord = self.minX + random.uniform(0,1)*(self.maxX-self.minX)
-            ycoord = self.minY + random.uniform(0,1)*(self.maxY-self.minY)
-            return Point(time,xcoord,ycoord)
+        target = self
+        if (self.aliasProb is not None):
+            k = random.randrange(len(self.aliasProb))
+            if (random.uniform(0,1) >= self.aliasProb[k]):
+                k = self.aliasIndex[k]
+            target = self.leve2cells[k]
+        xcoord = target.minX + random.uniform(0,1)*(target.maxX-target.minX)
+        ycoord = target.minY + random.uniform(0,1)*(target.maxY-target.minY)
+        return Point(time,xcoord,ycoord)
 
-    def divideFurther(self,noisydensity, EpsLeft,db):
-        lvl2cell = math.ceil(5*noisydensity/(len(db)*EpsLeft))
+    def getSampleTable(self):
+        # Subcell bounds and alias table used by Grid.sampleRandomPoints;
+        # a cell without usable level-2 densities is its own single subcell
+        if (self.aliasProb is None):
+            return [self.minX],[self.minY],[self.maxX-self.minX],[self.maxY-self.minY],np.ones(1),np.zeros(1,dtype=np.int64)
+        minXs = [c.minX for c in self.leve2cells]
+        minYs = [c.minY for c in self.leve2cells]
+        xIncs = [c.maxX-c.minX for c in self.leve2cells]
+        yIncs = [c.maxY-c.minY for c in self.leve2cells]
+        return minXs,minYs,xIncs,yIncs,self.aliasProb,self.aliasIndex
+
+    def level2Size(self, noisydensity, EpsLeft, dbSize):
+        lvl2cell = math.ceil(5*noisydensity/(dbSize*EpsLeft))
         if(lvl2cell <= 0):
             lvl2cell = 1
+        return min(lvl2cell,Config.LEVEL2_MAX_CELLS)
+
+    def level2Index(self, lvl2cell, xs, ys):
+        # Subcell id i*lvl2cell+j of points inside this cell
         xIncrement = (self.maxX-self.minX)/lvl2cell
         yIncrement = (self.maxY-self.minY)/lvl2cell
-        densities = []
+        i = np.zeros(len(xs),dtype=np.int64)
+        j = np.zeros(len(ys),dtype=np.int64)
+        if (xIncrement > 0):
+            i = np.clip(np.ceil((xs-self.minX)/xIncrement).astype(np.int64)-1,0,lvl2cell-1)
+        if (yIncrement > 0):
+            j = np.clip(np.ceil((ys-self.minY)/yIncrement).astype(np.int64)-1,0,lvl2cell-1)
+        return i*lvl2cell+j
+
+    def setLevel2(self, lvl2cell, counts):
+        xIncrement = (self.maxX-self.minX)/lvl2cell
+        yIncrement = (self.maxY-self.minY)/lvl2cell
+        self.leve2cells = []
         for i in range(lvl2cell):
             for j in range(lvl2cell):
-                lvl2cellSelf = Cell(self.minX+xIncrement*i, self.minY+yIncrement*j,xIncrement,yIncrement,str(i)+","+str(j))
-                lvl2cellDensity = 0
-                for t in db:
-                    for k in range(t.getSize()):
-                        if(lvl2cellSelf.inCell(t.getPoint(k))):
-                            lvl2cellDensity = lvl2cellDensity + 1
-                            break
-                self.leve2cells.append(lvl2cellSelf)
-                densities.append(lvl2cellDensity)
-        totoaldensity = 0
-        for d in densities:
-            totoaldensity = totoaldensity + d
-        for i in range(len(densities)):
-            if (totoaldensity != 0):
-                self.leve2densities.append(densities[i]/totoaldensity)
-            else:
-                self.leve2densities.append(0)
\ No newline at end of file
+                self.leve2cells.append(Cell(self.minX+xIncrement*i, self.minY+yIncrement*j,xIncrement,yIncrement,str(i)+","+str(j)))
+        totoaldensity = counts.sum()
+        self.aliasProb = None
+        self.aliasIndex = None
+        if (totoaldensity != 0):
+            self.leve2densities = (counts/totoaldensity).tolist()
+            if (len(counts) > 1):
+                self.aliasProb,self.aliasIndex = buildAliasTable(counts)
+        else:
+            self.leve2densities = [0]*len(counts)
+
+    def divideFurther(self,noisydensity, EpsLeft,db):
+        lvl2cell = self.level2Size(noisydensity,EpsLeft,len(db))
+        xs = []
+        ys = []
+        owners = []
+        for k in range(len(db)):
+            for p in db[k].getPoints():
+                xs.append(p.getX())
+                ys.append(p.getY())
+                owners.append(k)
+        xs = np.array(xs,dtype=np.float64)
+        ys = np.array(ys,dtype=np.float64)
+        inside = (xs >= self.minX) & (xs <= self.maxX) & (ys >= self.minY) & (ys <= self.maxY)
+        subcells = self.level2Index(lvl2cell,xs[inside],ys[inside])
+        counts = countTrajectoriesPerSubcell(subcells,np.array(owners,dtype=np.int64)[inside],lvl2cell*lvl2cell)
+        self.setLevel2(lvl2cell,counts)
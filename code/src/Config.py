@@ -0,0 +1,35 @@
+# Upper bound on the level-2 subdivision of one top-level cell, per axis
+LEVEL2_MAX_CELLS = 16
+
+# Spatial partition used for synthesis: 'uniform' is a CELL_COUNT x CELL_COUNT
+# Grid, 'quadtree' a QuadGrid split down to QUADTREE_MIN_COUNT points per leaf
+GRID_TYPE = 'uniform'
+CELL_COUNT = 6
+QUADTREE_MIN_COUNT = 64
+QUADTREE_MAX_DEPTH = 4
+
+# Memory cap of the process-wide cache of grids and gridded databases
+GRID_CACHE_BYTES = 256*1024*1024
+
+# Memory budget of the cached powers of one Markov transition matrix, and
+# of all matrices' powers together
+MARKOV_POWER_BYTES = 32*1024*1024
+MARKOV_CACHE_BYTES = 256*1024*1024
+
+# Processes synthesizing users in parallel (1 runs them in the calling
+# process, 0 uses every core) and the seed their per-user random
+# streams derive from (None draws a fresh one per run)
+SYN_WORKERS = 1
+SYN_SEED = None
+
+# Memory cap of the process-wide cache of per-user synthesis models
+MODEL_CACHE_BYTES = 256*1024*1024
+
+# Markov models over more cells than this keep their one-step matrix
+# sparse (transitions only reach neighbouring cells, so sparse products win
+# beyond about 8x8 cells)
+MARKOV_DENSE_CELLS = 64
+
+# Trajectories with more points than this get their diameter from the
+# convex hull; shorter ones compare all pairs of points
+DIAMETER_PAIRWISE_MAX = 64
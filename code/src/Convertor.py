@@ -1,40 +1,88 @@
 import numpy as np
 import pandas as pd
 import overload_function
-import time
+import os
+import gzip
+import json
+import shutil
 from typing import List
 from GridTrajectory import GridTrajectory
 from Trajectory import Trajectory
-from GowallaData import GowallaData
+from TrajectoryStore import TrajectoryStore
+from GowallaData import GowallaData, toEpochs, toUtcStrings, checkin_file_stat
 from TimeDistribution import TimeDistribution
 from Grid import Grid
 from Cell import Cell
+from Cache import gridCache
 
 def convertTrajToGridTraj(origDB, g:Grid, interp:bool, epsilon:float = None, unusedEpsilon:float = None):
-    tbr = []
+    cellIds,offsets = convertStoreToCellIds(origDB,g,interp)
+    tbr = convertCellIdsToGridTraj(cellIds,offsets,g)
     if(epsilon == None):
-        for t in origDB:
-            tbr.append(GridTrajectory(t,g,interp))
         return tbr
-    for t in origDB:
-        tbr.append(GridTrajectory(t,g,interp))
+    sizes = np.diff(offsets)
+    densities = np.bincount(cellIds,weights=np.repeat(1/np.maximum(sizes,1),sizes),minlength=g.getCellCount())
     cellDensities = {}
-    for c in g.getCells():
-        cellDensities[c] = 0
-    for t in tbr:
-        for c in t.getCells():
-            cellDensities[c] = cellDensities[c]+1/len(t.getCells())
+    for k,c in enumerate(g.getCells()):
+        cellDensities[c] = densities[k]
     ld = np.random.laplace(0,1/epsilon)
     for c in g.getCells():
         noisydensity = cellDensities[c]+ld
         if(noisydensity < 0.0010):
             noisydensity = 0
         cellDensities[c] = noisydensity
-    for c in g.getCells():
-        c.divideFurther(cellDensities[c],epsilon+unusedEpsilon,origDB)
+    g.divideFurther([cellDensities[c] for c in g.getCells()],epsilon+unusedEpsilon,origDB)
     return tbr
 
-def convertGridTrajToTraj(input,tb:TimeDistribution):
+def convertStoreToCellIds(origDB, g:Grid, interp:bool):
+    # The cells every GridTrajectory(t,g,interp) of the database would hold,
+    # as one int32 id array; trajectory k is cellIds[offsets[k]:offsets[k+1]]
+    store = TrajectoryStore.fromTrajectories(origDB)
+    key = ('cellIds',store.getFingerprint(),g.getKey(),interp)
+    cached = gridCache.get(key)
+    if (cached != None):
+        return cached
+    cellIds = g.locateIds(store.xs,store.ys,True)
+    sizes = store.getSizes()
+    offsets = np.concatenate(([0],np.cumsum(sizes)))
+    keep = np.ones(len(cellIds),dtype=bool)
+    keep[1:] = cellIds[1:] != cellIds[:-1]
+    keep[offsets[:-1][sizes > 0]] = True
+    kept = np.bincount(store.getTrajectoryIndex()[keep],minlength=len(sizes))
+    cellIds = cellIds[keep]
+    offsets = np.concatenate(([0],np.cumsum(kept)))
+    # A trajectory that never leaves its cell becomes [c,c]
+    single = np.nonzero(kept == 1)[0]
+    if (len(single) > 0):
+        cellIds = np.insert(cellIds,offsets[single],cellIds[offsets[single]])
+        kept[single] = 2
+        offsets = np.concatenate(([0],np.cumsum(kept)))
+    if (interp):
+        cellIds,offsets = g.interpolateIds(cellIds,offsets)
+    cellIds = cellIds.astype(np.int32)
+    offsets = offsets.astype(np.int64)
+    # Cached arrays are shared between callers
+    cellIds.flags.writeable = False
+    offsets.flags.writeable = False
+    return gridCache.put(key,(cellIds,offsets))
+
+def convertCellIdsToGridTraj(cellIds, offsets, g:Grid):
+    cells = g.getCells()
+    cellIds = cellIds.tolist()
+    return [GridTrajectory([cells[k] for k in cellIds[offsets[i]:offsets[i+1]]]) for i in range(len(offsets)-1)]
+
+def convertGridTrajToCellIds(input, g:Grid):
+    cellIds = []
+    offsets = [0]
+    for t in input:
+        cellIds.extend([g.getPosInListForm(c) for c in t.getCells()])
+        offsets.append(len(cellIds))
+    return np.array(cellIds,dtype=np.int64),np.array(offsets,dtype=np.int64)
+
+def convertGridTrajToTraj(input,tb:TimeDistribution,g:Grid = None):
+    if(g != None):
+        cellIds,offsets = convertGridTrajToCellIds(input,g)
+        return convertCellIdsToTraj(cellIds,offsets,tb,g)
     tbr = []
     for t in input:
         out = Trajectory()
@@ -44,60 +92,128 @@ def convertGridTrajToTraj(input,tb:TimeDistribution):
         tbr.append(out)
     return tbr
 
-def convertGowallaToTraj(gowalla:GowallaData):
+def convertCellIdsToTraj(cellIds,offsets,tb:TimeDistribution,g:Grid,rng = np.random):
+    # Times are drawn for the step at which a cell first appears in its trajectory
+    sizes = np.diff(offsets)
+    trajIndex = np.repeat(np.arange(len(sizes)),sizes)
+    positions = np.arange(len(cellIds))-np.repeat(offsets[:-1],sizes)
+    _,firstIndex,inverse = np.unique(trajIndex*g.getCellCount()+cellIds,return_index=True,return_inverse=True)
+    steps = positions[firstIndex][inverse.reshape(-1)]
+    times = tb.sampleBatch(steps,rng)
+    xs,ys = g.sampleRandomPoints(cellIds,rng)
+    return TrajectoryStore(xs,ys,times,offsets)
+
+def splitSessions(uids, epochs, gapHours:int = 4):
+    # Points of one user in the same (UTC) day whose hour is less than
+    # gapHours after the hour of the first point of the session -> traj
+    n = len(uids)
+    days = epochs//86400
+    hours = (epochs%86400)//3600
+    sessionStart = np.ones(n,dtype=bool)
+    sessionStart[1:] = (uids[1:] != uids[:-1]) | (days[1:] != days[:-1])
+    index = np.arange(n)
+    while(True):
+        anchor = hours[np.maximum.accumulate(np.where(sessionStart,index,0))]
+        pending = (hours-anchor >= gapHours) & ~sessionStart
+        if(not pending.any()):
+            break
+        newStart = pending.copy()
+        newStart[1:] &= ~pending[:-1]
+        sessionStart |= newStart
+    return sessionStart
+
+def sortCheckins(rawData):
+    # 'uid','utc','lat','lon','lid'
+    epochs = toEpochs(rawData['utc'])
+    uids = rawData['uid'].to_numpy()
+    order = np.lexsort((epochs,uids))
+    return order,uids[order],epochs[order]
+
+def convertGowallaToTraj(gowalla:GowallaData, gapHours:int = 4):
+    tbr = {}
+    for u,d in convertGowallaToStore(gowalla,gapHours).items():
+        tbr[u] = d.toTrajectories()
+    return tbr
+
+def convertGowallaToStore(gowalla:GowallaData, gapHours:int = 4):
     tbr = {}
     rawData = gowalla.getGowallaData()
-    uidlist = gowalla.getUidlist()
-    for u in uidlist:
-        traj = []
-        urawData = rawData.loc[rawData['uid'] == u]
-        urawData = urawData.sort_values(by=['utc'])
-        # 'uid','utc','lat','lon','lid'
-        lastDay = None
-        lastHour = None
-        oneTraj = Trajectory()
-        for i in range(len(urawData)):
-            line = urawData.iloc[i]
-            t = time.strptime(line['utc'],"%Y-%m-%dT%H:%M:%SZ")
-            day = time.strftime("%Y-%m-%d",t)
-            hour = t.tm_hour
-            if(lastDay == None):
-                lastDay = day
-                lastHour = hour
-            # Points in the same day and hours in 4-> traj
-            if(day == lastDay and hour - lastHour < 4):
-                oneTraj.addCoordinates(line['lat'],line['lon'],t)
-            else:
-                lastDay = day
-                lastHour = hour
-                traj.append(oneTraj)
-                oneTraj = Trajectory()
-                oneTraj.addCoordinates(line['lat'],line['lon'],t)
-        traj.append(oneTraj)
-        tbr[u] = traj
+    for u in gowalla.getUidlist():
+        tbr[u] = TrajectoryStore([],[],[],[0])
+    if(len(rawData) == 0):
+        return tbr
+    order,uids,epochs = sortCheckins(rawData)
+    sessionStarts = np.flatnonzero(splitSessions(uids,epochs,gapHours))
+    offsets = np.append(sessionStarts,len(uids))
+    store = TrajectoryStore(rawData['lat'].to_numpy()[order],rawData['lon'].to_numpy()[order],epochs,offsets)
+    # Every user owns a contiguous run of trajectories in the shared store
+    sessionUids = uids[sessionStarts]
+    userStarts = np.flatnonzero(np.append(True,sessionUids[1:] != sessionUids[:-1]))
+    userEnds = np.append(userStarts[1:],len(sessionStarts))
+    for i in range(len(userStarts)):
+        tbr[sessionUids[userStarts[i]]] = store.slice(userStarts[i],userEnds[i])
     return tbr
 
-def convertTrajToFile(db,filename:str):
+TRAJFILE_SUFFIXES = {'.gz':'gzip','.zst':'zstd','.parquet':'parquet'}
+
+def iterTrajChunks(db,chunksize:int):
     # items = ['uid','utc','lat','lon','lid']
-    dlist = {}
-    uidCol = []
-    utcCol = []
-    latCol = []
-    lonCol = []
+    pieces = []
+    buffered = 0
     for uid,d in db.items():
-        for t in d:
-            points = t.getPoints()
-            for p in points:
-                uidCol.append(uid)
-                utcCol.append(time.strftime("%Y-%m-%dT%H:%M:%SZ",p.getTime()))
-                latCol.append(p.getX())
-                lonCol.append(p.getY())
-    dlist['uid'] = uidCol
-    dlist['utc'] = utcCol
-    dlist['lat'] = latCol
-    dlist['lon'] = lonCol
-    df = pd.DataFrame(dlist)
-    df.to_csv(filename,index=False)
+        store = TrajectoryStore.fromTrajectories(d)
+        for start in range(0,store.getPointCount(),chunksize):
+            stop = min(start+chunksize,store.getPointCount())
+            pieces.append((uid,store.xs[start:stop],store.ys[start:stop],store.times[start:stop]))
+            buffered += stop-start
+            if (buffered >= chunksize):
+                yield trajChunkFrame(pieces)
+                pieces = []
+                buffered = 0
+    if (len(pieces) > 0):
+        yield trajChunkFrame(pieces)
+
+def trajChunkFrame(pieces):
+    dlist = {}
+    dlist['uid'] = np.concatenate([np.full(len(p[1]),p[0]) for p in pieces])
+    dlist['utc'] = toUtcStrings(np.concatenate([p[3] for p in pieces]))
+    dlist['lat'] = np.concatenate([p[1] for p in pieces])
+    dlist['lon'] = np.concatenate([p[2] for p in pieces])
+    return pd.DataFrame(dlist)
+
+def openTrajFile(filename:str,compression:str):
+    if (compression == 'gzip'):
+        return gzip.open(filename,'wt',newline='')
+    if (compression == 'zstd'):
+        import zstandard
+        return zstandard.open(filename,'wt',newline='')
+    return open(filename,'w',newline='')
+
+def convertTrajToFile(db,filename:str,compression:str = 'infer',chunksize:int = 1000000):
+    # compression: None, 'gzip', 'zstd', 'parquet' or 'infer' from the filename
+    if (compression == 'infer'):
+        compression = TRAJFILE_SUFFIXES.get(os.path.splitext(filename)[1])
+    if (compression == 'parquet'):
+        import pyarrow
+        import pyarrow.parquet
+        writer = None
+        for df in iterTrajChunks(db,chunksize):
+            table = pyarrow.Table.from_pandas(df,preserve_index=False)
+            if (writer == None):
+                writer = pyarrow.parquet.ParquetWriter(filename,table.schema)
+            writer.write_table(table.cast(writer.schema))
+        if (writer == None):
+            pd.DataFrame(columns=['uid','utc','lat','lon']).to_parquet(filename,index=False)
+        else:
+            writer.close()
+        return
+    with openTrajFile(filename,compression) as f:
+        header = True
+        for df in iterTrajChunks(db,chunksize):
+            df.to_csv(f,index=False,header=header)
+            header = False
+        if (header):
+            f.write('uid,utc,lat,lon\n')
 
 def convertDbToList(db):
     tbr = []
@@ -105,6 +221,59 @@ def convertDbToList(db):
         tbr.extend(d)
     return tbr
 
+TRAJDB_VERSION = 1
+TRAJDB_ARRAYS = ['xs','ys','times','offsets','uids','uidOffsets']
+
+def saveTrajDB(db,path:str,source:str = None):
+    # Directory of .npy arrays: points of all users back to back, trajectory
+    # offsets into the points and uidOffsets into the trajectories
+    uids = list(db.keys())
+    stores = [TrajectoryStore.fromTrajectories(db[u]) for u in uids]
+    store = TrajectoryStore.concat(stores)
+    arrays = {}
+    arrays['xs'] = store.xs
+    arrays['ys'] = store.ys
+    arrays['times'] = store.times
+    arrays['offsets'] = store.offsets-store.offsets[0]
+    arrays['uids'] = np.array(uids)
+    arrays['uidOffsets'] = np.cumsum([0]+[len(s) for s in stores]).astype(np.int64)
+    meta = {'version':TRAJDB_VERSION,'users':len(uids),'trajectories':len(store),'points':store.getPointCount()}
+    if (source != None):
+        meta['source'] = checkin_file_stat(source).tolist()
+    tmp = path+'.tmp'
+    if (os.path.exists(tmp)):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    for name in TRAJDB_ARRAYS:
+        np.save(os.path.join(tmp,name+'.npy'),arrays[name],allow_pickle=False)
+    with open(os.path.join(tmp,'meta.json'),'w') as f:
+        json.dump(meta,f)
+    if (os.path.exists(path)):
+        shutil.rmtree(path)
+    os.rename(tmp,path)
+
+def openTrajDB(path:str,source:str = None):
+    # Arrays are memory-mapped read-only, every user gets a view into them
+    metafile = os.path.join(path,'meta.json')
+    if (not os.path.exists(metafile)):
+        return None
+    with open(metafile) as f:
+        meta = json.load(f)
+    if (meta.get('version') != TRAJDB_VERSION):
+        return None
+    if (source != None and meta.get('source') != checkin_file_stat(source).tolist()):
+        return None
+    arrays = {}
+    for name in TRAJDB_ARRAYS:
+        arrays[name] = np.load(os.path.join(path,name+'.npy'),mmap_mode='r',allow_pickle=False)
+    store = TrajectoryStore(arrays['xs'],arrays['ys'],arrays['times'],arrays['offsets'])
+    uids = arrays['uids'].tolist()
+    uidOffsets = arrays['uidOffsets']
+    tbr = {}
+    for i in range(len(uids)):
+        tbr[uids[i]] = store.slice(uidOffsets[i],uidOffsets[i+1])
+    return tbr
+
 if __name__ == "__main__":
     Gowalla = GowallaData()
     Gowalla.read_checkin_file('/home/Gowalla_sample.txt')
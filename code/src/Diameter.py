@@ -0,0 +1,82 @@
+import numpy as np
+import Config
+
+def convexHull(xs, ys):
+    # Indices of the hull vertices in counter-clockwise order (monotone
+    # chain). Points within rounding error of collinear are dropped, so a
+    # segment gives two vertices and the calipers never compare noise
+    order = np.lexsort((ys,xs))
+    pts = list(zip(xs[order].tolist(),ys[order].tolist(),order.tolist()))
+    span = max(float(xs.max()-xs.min()),float(ys.max()-ys.min()))
+    eps = 1e-12*span*span
+    def half(points):
+        chain = []
+        for p in points:
+            while (len(chain) >= 2 and (chain[-1][0]-chain[-2][0])*(p[1]-chain[-2][1])-(chain[-1][1]-chain[-2][1])*(p[0]-chain[-2][0]) <= eps):
+                chain.pop()
+            chain.append(p)
+        return chain
+    lower = half(pts)
+    upper = half(reversed(pts))
+    hull = lower[:-1]+upper[:-1]
+    if (len(hull) == 0):
+        hull = pts[:1]
+    return np.array([p[2] for p in hull],dtype=np.int64)
+
+def rotatingCalipers(xs, ys):
+    # Largest squared distance between the vertices of a convex polygon
+    # given counter-clockwise, visiting only antipodal pairs
+    h = len(xs)
+    if (h < 2):
+        return 0.0
+    if (h == 2):
+        return (xs[0]-xs[1])**2+(ys[0]-ys[1])**2
+    def area(i, j, k):
+        return abs((xs[j]-xs[i])*(ys[k]-ys[i])-(ys[j]-ys[i])*(xs[k]-xs[i]))
+    best = 0.0
+    j = 1
+    for i in range(h):
+        ni = (i+1)%h
+        while (area(i,ni,(j+1)%h) > area(i,ni,j)):
+            j = (j+1)%h
+        best = max(best,(xs[i]-xs[j])**2+(ys[i]-ys[j])**2,(xs[ni]-xs[j])**2+(ys[ni]-ys[j])**2)
+    return best
+
+def diameter(xs, ys):
+    # Largest distance between two of the points
+    xs = np.asarray(xs,dtype=np.float64)
+    ys = np.asarray(ys,dtype=np.float64)
+    if (len(xs) < 2):
+        return 0.0
+    if (len(xs) <= Config.DIAMETER_PAIRWISE_MAX):
+        dx = xs[:,None]-xs[None,:]
+        dy = ys[:,None]-ys[None,:]
+        return float(np.sqrt((dx*dx+dy*dy).max()))
+    hull = convexHull(xs,ys)
+    return float(np.sqrt(rotatingCalipers(xs[hull].tolist(),ys[hull].tolist())))
+
+def diameters(xs, ys, offsets):
+    # Diameter of every trajectory of a flat xs/ys/offsets layout. Short
+    # trajectories are padded with their last point to a common size and
+    # done together in chunks, long ones one by one through their hull
+    xs = np.asarray(xs,dtype=np.float64)
+    ys = np.asarray(ys,dtype=np.float64)
+    offsets = np.asarray(offsets,dtype=np.int64)
+    sizes = np.diff(offsets)
+    tbr = np.zeros(len(sizes))
+    short = np.nonzero((sizes >= 2) & (sizes <= Config.DIAMETER_PAIRWISE_MAX))[0]
+    if (len(short) > 0):
+        width = int(sizes[short].max())
+        chunk = max(1,(1 << 22)//(width*width))
+        for first in range(0,len(short),chunk):
+            rows = short[first:first+chunk]
+            cols = np.minimum(np.arange(width)[None,:],sizes[rows][:,None]-1)
+            index = offsets[rows][:,None]+cols
+            px = xs[index]
+            py = ys[index]
+            dx = px[:,:,None]-px[:,None,:]
+            dy = py[:,:,None]-py[:,None,:]
+            tbr[rows] = np.sqrt((dx*dx+dy*dy).max(axis=(1,2)))
+    for k in np.nonzero(sizes > Config.DIAMETER_PAIRWISE_MAX)[0].tolist():
+        tbr[k] = diameter(xs[offsets[k]:offsets[k+1]],ys[offsets[k]:offsets[k+1]])
+    return tbr
@@ -1,16 +1,17 @@
-import math
+import numpy as np
 from Trajectory import Trajectory
-from GridTrajectory import GridTrajectory
+from TrajectoryStore import TrajectoryStore
 from typing import List
 from Query import Query
 from Grid import Grid
 import Util
 import Convertor
-import time
-from Pattern import Pattern
+from Cell import countTrajectoriesPerSubcell
 
 class Evaluation(object):
     def __init__(self,ptime,oDB,sDB):
+        oDB = TrajectoryStore.fromTrajectories(oDB)
+        sDB = TrajectoryStore.fromTrajectories(sDB)
         self.eva = []
         self.eva.append(ptime)
         self.eva.append(DiameterError(oDB,sDB,40))
@@ -26,181 +27,67 @@ class Evaluation(object):
 
 
 def calcJSD(origProb, synProb):
-    avgProb = []
-    for i in range(len(origProb)):
-        avgProb.append((origProb[i]+synProb[i])/2)
+    origProb = np.asarray(origProb,dtype=np.float64)
+    synProb = np.asarray(synProb,dtype=np.float64)
+    avgProb = (origProb+synProb)/2
     return 0.5*calcKL(origProb,avgProb) + 0.5*calcKL(synProb,avgProb)
 
 def calcKL(p1,p2):
-    KL = 0
-    for i in range(len(p1)):
-        q = p2[i]
-        p = p1[i]
-        if (p != 0):
-            KL += math.log(p/q)*p
-    return KL
+    p = np.asarray(p1,dtype=np.float64)
+    q = np.asarray(p2,dtype=np.float64)
+    nonZero = p != 0
+    return float((np.log(p[nonZero]/q[nonZero])*p[nonZero]).sum())
+
+def bucketProbs(values, minf, bucketSize, bucketNum:int):
+    # Share of the values in each bucket [l,r]; both ends are closed, so a
+    # value on the edge between two buckets is counted in both
+    values = np.sort(values)
+    l = np.arange(bucketNum)*bucketSize+minf
+    r = (np.arange(bucketNum)+1)*bucketSize+minf
+    count = np.searchsorted(values,r,'right')-np.searchsorted(values,l,'left')
+    return count/len(values)
+
+def histogramJSD(originalValues, syntheticValues, bucketNum:int):
+    # JSD of the two value distributions over bucketNum equal buckets
+    # spanning the original values
+    minf = originalValues.min()
+    maxf = originalValues.max()
+    bucketSize = (maxf-minf)/bucketNum
+    return calcJSD(bucketProbs(originalValues,minf,bucketSize,bucketNum),bucketProbs(syntheticValues,minf,bucketSize,bucketNum))
 
 def DiameterError(origin:List[Trajectory], syn:List[Trajectory], bucketNum:int):
-    minf = float('inf')
-    maxf = float('-inf')
-    originalDiameters = []
-    for t in origin:
-        dia = t.getDiameter()
-        originalDiameters.append(dia)
-        if (dia < minf):
-            minf = dia
-        if (dia > maxf):
-            maxf = dia
-    syntheticDiameters = []
-    for t in syn:
-        syntheticDiameters.append(t.getDiameter())
-    bucketSize = (maxf-minf)/bucketNum
-    originDiaCount = []
-    synDiaCount = []
-    for i in range(bucketNum):
-        l = i*bucketSize+minf
-        r = (i+1)*bucketSize+minf
-        cnt = 0
-        for d in originalDiameters:
-            if (d >= l and d <= r):
-                cnt += 1
-        originDiaCount.append(cnt)
-        cnt = 0
-        for d in syntheticDiameters:
-            if (d >= l and d <= r):
-                cnt += 1
-        synDiaCount.append(cnt)
-    originDiaProbs = []
-    synDiaProbs = []
-    for i in range(bucketNum):
-        originDiaProbs.append(originDiaCount[i]/len(originalDiameters))
-        synDiaProbs.append(synDiaCount[i]/len(syntheticDiameters))
-    return calcJSD(originDiaProbs, synDiaProbs)
+    originalDiameters = TrajectoryStore.fromTrajectories(origin).getDiameters()
+    syntheticDiameters = TrajectoryStore.fromTrajectories(syn).getDiameters()
+    return histogramJSD(originalDiameters,syntheticDiameters,bucketNum)
 
 def DistanceError(origin:List[Trajectory], syn:List[Trajectory], bucketNum:int):
-    minf = float('inf')
-    maxf = float('-inf')
-    originalDistance = []
-    for t in origin:
-        dia = t.getDistanceTravelled()
-        originalDistance.append(dia)
-        if (dia < minf):
-            minf = dia
-        if (dia > maxf):
-            maxf = dia
-    syntheticDistance = []
-    for t in syn:
-        syntheticDistance.append(t.getDistanceTravelled())
-    bucketSize = (maxf-minf)/bucketNum
-    originDiaCount = []
-    synDiaCount = []
-    for i in range(bucketNum):
-        l = i*bucketSize+minf
-        r = (i+1)*bucketSize+minf
-        cnt = 0
-        for d in originalDistance:
-            if (d >= l and d <= r):
-                cnt += 1
-        originDiaCount.append(cnt)
-        cnt = 0
-        for d in syntheticDistance:
-            if (d >= l and d <= r):
-                cnt += 1
-        synDiaCount.append(cnt)
-    originDiaProbs = []
-    synDiaProbs = []
-    for i in range(bucketNum):
-        originDiaProbs.append(originDiaCount[i]/len(originalDistance))
-        synDiaProbs.append(synDiaCount[i]/len(syntheticDistance))
-    return calcJSD(originDiaProbs, synDiaProbs)
+    originalDistance = TrajectoryStore.fromTrajectories(origin).getDistancesTravelled()
+    syntheticDistance = TrajectoryStore.fromTrajectories(syn).getDistancesTravelled()
+    return histogramJSD(originalDistance,syntheticDistance,bucketNum)
 
 def TimeError(origin:List[Trajectory], syn:List[Trajectory], bucketNum:int=24):
-    minf = float('inf')
-    maxf = float('-inf')
-    originalTime = []
-    for t in origin:
-        points = t.getPoints()
-        for p in points:
-            ptime = time.mktime(p.getTime())
-            originalTime.append(ptime)
-            if (ptime < minf):
-                minf = ptime
-            if (ptime > maxf):
-                maxf = ptime
-    syntheticTime = []
-    for t in syn:
-        points = t.getPoints()
-        for p in points:
-            ptime = time.mktime(p.getTime())
-            syntheticTime.append(ptime)
-    bucketSize = (maxf-minf)/bucketNum
-    originCount = []
-    synCount = []
-    for i in range(bucketNum):
-        l = i*bucketSize+minf
-        r = (i+1)*bucketSize+minf
-        cnt = 0
-        for d in originalTime:
-            if (d >= l and d <= r):
-                cnt += 1
-        originCount.append(cnt)
-        cnt = 0
-        for d in syntheticTime:
-            if (d >= l and d <= r):
-                cnt += 1
-        synCount.append(cnt)
-    originProbs = []
-    synProbs = []
-    for i in range(bucketNum):
-        originProbs.append(originCount[i]/len(originalTime))
-        synProbs.append(synCount[i]/len(syntheticTime))
-    return calcJSD(originProbs, synProbs)
+    originalTime = TrajectoryStore.fromTrajectories(origin).times
+    syntheticTime = TrajectoryStore.fromTrajectories(syn).times
+    return histogramJSD(originalTime,syntheticTime,bucketNum)
 
 def PFError(origin:List[Trajectory], syn:List[Trajectory]):
-    boundaries = Util.getDataBoundaries(origin)
-    minX = boundaries[0]
-    maxX = boundaries[1]
-    minY = boundaries[2]
-    maxY = boundaries[3]
-    ug = Grid(15,minX,maxX,minY,maxY)
-    originDBgrid = Convertor.convertTrajToGridTraj(origin,ug,True)
-    synDBgrid = Convertor.convertTrajToGridTraj(syn,ug,True)
-    cells = ug.getCells()
-    originCount = []
-    synCount = []
-    originNum = 0
-    synNum = 0
-    for i in range(len(cells)):
-        cnt = 0
-        for t in originDBgrid:
-            if (t.passesThrough(cells[i])):
-                cnt += 1
-        originCount.append(cnt)
-        originNum += cnt
-        cnt = 0
-        for t in synDBgrid:
-            if (t.passesThrough(cells[i])):
-                cnt += 1
-        synCount.append(cnt)
-        synNum += cnt
-    originProbs = []
-    synProbs = []
-    for i in range(len(cells)):
-        originProbs.append(originCount[i]/originNum)
-        synProbs.append(synCount[i]/synNum)
+    ug = Util.getGrid(origin,15,'uniform')
+    originCount = passThroughCounts(origin,ug)
+    synCount = passThroughCounts(syn,ug)
+    originProbs = (originCount/originCount.sum()).tolist()
+    synProbs = (synCount/synCount.sum()).tolist()
     return calcJSD(originProbs, synProbs)
 
+def passThroughCounts(db, g:Grid):
+    # Number of trajectories passing through each cell
+    cellIds,offsets = Convertor.convertStoreToCellIds(db,g,True)
+    owners = np.repeat(np.arange(len(offsets)-1),np.diff(offsets))
+    return countTrajectoriesPerSubcell(cellIds.astype(np.int64),owners,g.getCellCount())
+
 def FPError(origin:List[Trajectory], syn:List[Trajectory]):
-    boundaries = Util.getDataBoundaries(origin)
-    minX = boundaries[0]
-    maxX = boundaries[1]
-    minY = boundaries[2]
-    maxY = boundaries[3]
-    ug = Grid(15,minX,maxX,minY,maxY)
-    originDBgrid = Convertor.convertTrajToGridTraj(origin,ug,True)
-    synDBgrid = Convertor.convertTrajToGridTraj(syn,ug,True)
-    originPattern = minePatterns(originDBgrid)
-    synPattern = minePatterns(synDBgrid)
+    ug = Util.getGrid(origin,15,'uniform')
+    originPattern = minePatterns(*Convertor.convertStoreToCellIds(origin,ug,True))
+    synPattern = minePatterns(*Convertor.convertStoreToCellIds(syn,ug,True))
     oCount = []
     sCount = []
     oNum = 0
@@ -220,16 +107,20 @@ def FPError(origin:List[Trajectory], syn:List[Trajectory]):
 
 
 
-def minePatterns(db,minSize=2,maxSize=8):
+def minePatterns(cellIds,offsets,minSize=2,maxSize=8):
+    # Occurrences of every run of minSize..maxSize consecutive cells, keyed
+    # by the tuple of cell ids
     tbr = {}
+    cellIds = np.asarray(cellIds,dtype=np.int64)
+    ends = np.repeat(offsets[1:],np.diff(offsets))
+    starts = np.arange(len(cellIds))
     for i in range(minSize,maxSize+1):
-        for t in db:
-            for k in range(len(t.getCells())-i+1):
-                p = Pattern(t.getCells()[k:k+i])
-                if (p in tbr):
-                    tbr[p] = tbr[p]+1
-                else:
-                    tbr[p] = 1
+        first = starts[starts+i <= ends]
+        if (len(first) == 0):
+            continue
+        patterns,counts = np.unique(cellIds[first[:,None]+np.arange(i)],axis=0,return_counts=True)
+        for p,n in zip(patterns.tolist(),counts.tolist()):
+            tbr[tuple(p)] = n
     return tbr
 
 
@@ -265,25 +156,9 @@ def GenerateQueries(db:List[Trajectory],count:int):
     return tbr
 
 def locationKendallTau(origin:List[Trajectory],syn:List[Trajectory],gridCell:int=15):
-    boundaries = Util.getDataBoundaries(origin)
-    minX = boundaries[0]
-    maxX = boundaries[1]
-    minY = boundaries[2]
-    maxY = boundaries[3]
-    ug = Grid(gridCell,minX,maxX,minY,maxY)
-    originDBgrid = Convertor.convertTrajToGridTraj(origin,ug,True)
-    synDBgrid = Convertor.convertTrajToGridTraj(syn,ug,True)
-    cells = ug.getCells()
-    actualCounts = [0]*len(cells)
-    synCounts = [0]*len(cells)
-    for i in range(len(cells)):
-        c = cells[i]
-        for t in originDBgrid:
-            if (t.passesThrough(c)):
-                actualCounts[i] += 1
-        for t in synDBgrid:
-            if (t.passesThrough(c)):
-                synCounts[i] += 1
+    ug = Util.getGrid(origin,gridCell,'uniform')
+    actualCounts = passThroughCounts(origin,ug).tolist()
+    synCounts = passThroughCounts(syn,ug).tolist()
     concordantPairs = 0
     reversedPairs = 0
     for i in range(len(actualCounts)):
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import Diameter
 
 class UsrFeature(object):
     def __init__(self, usrData):
@@ -32,15 +33,4 @@ class UsrFeature(object):
         return self.radius
         
 def range_radius(lat, lon):
-    radius = 0
-    points = []
-    for i in range(len(lat)):
-        p = np.array(lat[i],lon[i])
-        points.append(p)
-    for i in range(len(points)):
-        for j in range(i+1,len(points)):
-            dis = np.linalg.norm(points[i]-points[j])
-            if (dis > radius):
-                radius = dis
-    return radius
-
+    return Diameter.diameter(np.asarray(lat,dtype=np.float64),np.asarray(lon,dtype=np.float64))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import numpy as np
 import pandas as pd
 import scipy
@@ -10,15 +11,35 @@ from matplotlib import pyplot as plt
 
 from Feature import UsrFeature
 
+UTC_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+CACHE_VERSION = 1
+
+def toEpochs(utc):
+    utc = utc.infer_objects()
+    if (pd.api.types.is_numeric_dtype(utc)):
+        return utc.to_numpy().astype(np.int64)
+    return pd.to_datetime(utc,format=UTC_FORMAT).to_numpy().astype('datetime64[s]').astype(np.int64)
+
+def toUtcStrings(epochs):
+    iso = np.datetime_as_string(np.asarray(epochs,dtype=np.int64).astype('datetime64[s]'),unit='s')
+    return np.char.add(iso,'Z')
+
 class GowallaData(object):
     def __init__(self):
         self.dfc = pd.DataFrame(index=[],columns=[])
         self.feature_map = {}
     
-    def read_checkin_file(self, filename, items = ['uid','utc','lat','lon','lid']):
+    def read_checkin_file(self, filename, items = ['uid','utc','lat','lon','lid'], chunksize = 1000000, cache = True):
         print('Checkin Filename:',filename)
-        self.dfc = pd.read_table(filename,header=None)
-        self.dfc.columns = items
+        cachefile = filename + '.npz'
+        columns = None
+        if (cache):
+            columns = load_checkin_cache(filename,cachefile)
+        if (columns is None):
+            columns = read_checkin_chunks(filename,chunksize)
+            if (cache):
+                save_checkin_cache(filename,cachefile,columns)
+        self.dfc = pd.DataFrame({items[i]:columns[i] for i in range(len(items))})
         self.uid_list = self.dfc['uid'].unique()
 
     def load_from_dfc(self,dfc,items = ['uid','utc','lat','lon','lid']):
@@ -53,6 +74,45 @@ class GowallaData(object):
                 break
             init_num = init_num - 1
         
+def checkin_file_stat(filename):
+    st = os.stat(filename)
+    return np.array([st.st_size,st.st_mtime_ns],dtype=np.int64)
+
+def read_checkin_chunks(filename, chunksize):
+    # uid, utc (epoch seconds), lat, lon, lid
+    dtypes = [np.int32,np.int64,np.float64,np.float64,np.int32]
+    parts = [[] for _ in dtypes]
+    reader = pd.read_csv(filename,sep='\t',header=None,usecols=range(5),chunksize=chunksize,
+        dtype={0:np.int32,1:str,2:np.float64,3:np.float64,4:np.int32})
+    for chunk in reader:
+        parts[0].append(chunk[0].to_numpy())
+        parts[1].append(toEpochs(chunk[1]))
+        parts[2].append(chunk[2].to_numpy())
+        parts[3].append(chunk[3].to_numpy())
+        parts[4].append(chunk[4].to_numpy())
+    return [np.concatenate(parts[i]).astype(dtypes[i]) if parts[i] else np.zeros(0,dtype=dtypes[i]) for i in range(len(dtypes))]
+
+def load_checkin_cache(filename, cachefile):
+    if (not os.path.exists(cachefile)):
+        return None
+    try:
+        with np.load(cachefile) as cached:
+            if (int(cached['version']) != CACHE_VERSION):
+                return None
+            if (not np.array_equal(cached['source'],checkin_file_stat(filename))):
+                return None
+            return [cached['col'+str(i)] for i in range(5)]
+    except (OSError,KeyError,ValueError):
+        return None
+
+def save_checkin_cache(filename, cachefile, columns):
+    arrays = {'col'+str(i):columns[i] for i in range(len(columns))}
+    try:
+        with open(cachefile,'wb') as f:
+            np.savez(f,version=CACHE_VERSION,source=checkin_file_stat(filename),**arrays)
+    except OSError:
+        print('Checkin cache not written:',cachefile)
+
 def CheckCluster(result, number, k):
     r = list(result)
     fail_count = 0
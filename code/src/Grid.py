@@ -1,41 +1,244 @@
-from Cell import Cell
+import math
+import numpy as np
+from Cell import Cell, countTrajectoriesPerSubcell
+from TrajectoryStore import TrajectoryStore
 from typing import List
 
+def axisIndex(values, minV, maxV, increment, n, clip):
+    # Cells are closed intervals scanned from the lower index, so a value on
+    # a shared edge belongs to the lower cell: index = ceil(offset)-1
+    values = np.asarray(values,dtype=np.float64)
+    if (increment > 0):
+        index = np.ceil((values-minV)/increment).astype(np.int64)-1
+    else:
+        index = np.zeros(len(values),dtype=np.int64)
+    index = np.clip(index,0,n-1)
+    if (not clip):
+        index[~((values >= minV) & (values <= maxV))] = -1
+    return index
+
+def level2AxisIndex(values, cellMin, cellIncrement, lvl2cell):
+    safe = np.where(cellIncrement > 0,cellIncrement,1)
+    index = np.clip(np.ceil((values-cellMin)*lvl2cell/safe).astype(np.int64)-1,0,lvl2cell-1)
+    return np.where(cellIncrement > 0,index,0)
+
 class Grid(object):
     def __init__(self, cellCount, minX, maxX, minY, maxY):
+        self.minX = minX
+        self.maxX = maxX
+        self.minY = minY
+        self.maxY = maxY
         self.topLevelCells = [[0]*cellCount for _ in range(cellCount)]
         xIncrement = (maxX-minX)/cellCount
         yIncrement = (maxY-minY)/cellCount
+        self.xIncrement = xIncrement
+        self.yIncrement = yIncrement
+        self.cells = []
+        self.cellPos = {}
+        self.posInListForm = {}
         for i in range(cellCount):
             for j in range(cellCount):
-                self.topLevelCells[i][j] = Cell(minX+xIncrement*i,minY+yIncrement*j,xIncrement,yIncrement,str(i)+","+str(j))
-        self.posInListForm = {}
-        for i in range(len(self.getCells())):
-            self.posInListForm[self.getCells()[i]] = i
+                c = Cell(minX+xIncrement*i,minY+yIncrement*j,xIncrement,yIncrement,str(i)+","+str(j))
+                self.topLevelCells[i][j] = c
+                self.cellPos[c] = (i,j)
+                self.posInListForm[c] = len(self.cells)
+                self.cells.append(c)
+        self.buildNeighbours()
+        self.sampleTable = None
+        self.cellBounds = None
+
+    def buildNeighbours(self):
+        # CSR neighbour table over cell ids (id = i*N+j)
+        n = self.getN()
+        ids = np.arange(n*n)
+        ci = ids//n
+        cj = ids%n
+        table = np.full((n*n,8),-1,dtype=np.int64)
+        k = 0
+        for di in (-1,0,1):
+            for dj in (-1,0,1):
+                if (di == 0 and dj == 0):
+                    continue
+                ni = ci+di
+                nj = cj+dj
+                valid = (ni >= 0) & (ni < n) & (nj >= 0) & (nj < n)
+                table[valid,k] = ni[valid]*n+nj[valid]
+                k += 1
+        # Padded with -1 after the valid ids of each row, ids ascending
+        table[table < 0] = n*n
+        table.sort(axis=1)
+        table[table == n*n] = -1
+        self.neighbourTable = table
+        valid = table >= 0
+        self.neighbourOffsets = np.concatenate(([0],np.cumsum(valid.sum(axis=1)))).astype(np.int64)
+        self.neighbourIds = table[valid]
+
+    def getKey(self):
+        # Layout identity: grids with equal keys assign points to the same ids
+        return ('uniform',self.minX,self.maxX,self.minY,self.maxY,self.getN())
 
     def getN(self):
         return len(self.topLevelCells)
 
+    def divideFurther(self, noisyDensities, EpsLeft, db):
+        # Level-2 densities of every cell from one pass over the flattened
+        # points; noisyDensities follows the getCells order
+        store = TrajectoryStore.fromTrajectories(db)
+        sizes = np.array([c.level2Size(noisyDensities[k],EpsLeft,len(db)) for k,c in enumerate(self.cells)],dtype=np.int64)
+        subcellOffsets = np.concatenate(([0],np.cumsum(sizes*sizes)))
+        cellIds = self.locateIds(store.xs,store.ys)
+        inside = cellIds >= 0
+        cellIds = cellIds[inside]
+        lvl2cell = sizes[cellIds]
+        minXs,minYs,xIncs,yIncs = self.getCellBounds()
+        subI = level2AxisIndex(store.xs[inside],minXs[cellIds],xIncs[cellIds],lvl2cell)
+        subJ = level2AxisIndex(store.ys[inside],minYs[cellIds],yIncs[cellIds],lvl2cell)
+        subcells = subcellOffsets[cellIds]+subI*lvl2cell+subJ
+        owners = store.getTrajectoryIndex()[inside]
+        counts = countTrajectoriesPerSubcell(subcells,owners,int(subcellOffsets[-1]))
+        for k,c in enumerate(self.cells):
+            c.setLevel2(int(sizes[k]),counts[subcellOffsets[k]:subcellOffsets[k+1]])
+        self.sampleTable = None
+
+    def buildSampleTable(self):
+        # Alias tables of all cells flattened; subcell ids are global
+        tables = [c.getSampleTable() for c in self.cells]
+        sizes = np.array([len(t[4]) for t in tables],dtype=np.int64)
+        offsets = np.concatenate(([0],np.cumsum(sizes))).astype(np.int64)
+        self.sampleTable = {}
+        self.sampleTable['offsets'] = offsets
+        self.sampleTable['sizes'] = sizes
+        self.sampleTable['minX'] = np.concatenate([t[0] for t in tables]).astype(np.float64)
+        self.sampleTable['minY'] = np.concatenate([t[1] for t in tables]).astype(np.float64)
+        self.sampleTable['xInc'] = np.concatenate([t[2] for t in tables]).astype(np.float64)
+        self.sampleTable['yInc'] = np.concatenate([t[3] for t in tables]).astype(np.float64)
+        self.sampleTable['prob'] = np.concatenate([t[4] for t in tables]).astype(np.float64)
+        self.sampleTable['alias'] = np.concatenate([np.asarray(tables[k][5])+offsets[k] for k in range(len(tables))]).astype(np.int64)
+
+    def sampleRandomPoints(self, cellIds, rng = np.random):
+        # Vectorized Cell.sampleRandomPoint for an array of cell ids
+        if (self.sampleTable == None):
+            self.buildSampleTable()
+        table = self.sampleTable
+        cellIds = np.asarray(cellIds,dtype=np.int64)
+        n = len(cellIds)
+        columns = table['offsets'][cellIds]+np.minimum((rng.random(n)*table['sizes'][cellIds]).astype(np.int64),table['sizes'][cellIds]-1)
+        subcells = np.where(rng.random(n) < table['prob'][columns],columns,table['alias'][columns])
+        xs = table['minX'][subcells]+rng.random(n)*table['xInc'][subcells]
+        ys = table['minY'][subcells]+rng.random(n)*table['yInc'][subcells]
+        return xs,ys
+
+    def locate(self, x, y):
+        # (i,j) of the cell containing the point, (-1,-1) outside the grid
+        if (not (x >= self.minX and x <= self.maxX and y >= self.minY and y <= self.maxY)):
+            return (-1,-1)
+        n = self.getN()
+        i = 0
+        j = 0
+        if (self.xIncrement > 0):
+            i = min(max(math.ceil((x-self.minX)/self.xIncrement)-1,0),n-1)
+        if (self.yIncrement > 0):
+            j = min(max(math.ceil((y-self.minY)/self.yIncrement)-1,0),n-1)
+        return (i,j)
+
+    def locateBatch(self, xs, ys, clip:bool = False):
+        # Arrays of i and j; points outside the grid get -1 unless clip snaps
+        # them to the nearest border cell
+        n = self.getN()
+        i = axisIndex(xs,self.minX,self.maxX,self.xIncrement,n,clip)
+        j = axisIndex(ys,self.minY,self.maxY,self.yIncrement,n,clip)
+        if (not clip):
+            outside = (i < 0) | (j < 0)
+            i[outside] = -1
+            j[outside] = -1
+        return i,j
+
+    def locateId(self, x, y):
+        i,j = self.locate(x,y)
+        if (i < 0):
+            return -1
+        return i*self.getN()+j
+
+    def locateIds(self, xs, ys, clip:bool = False):
+        i,j = self.locateBatch(xs,ys,clip)
+        return np.where(i >= 0,i*self.getN()+j,-1)
+
+    def getCellBounds(self):
+        # minX, minY, width and height of every cell as arrays in id order
+        if (self.cellBounds == None):
+            self.cellBounds = (np.array([c.minX for c in self.cells],dtype=np.float64),
+                np.array([c.minY for c in self.cells],dtype=np.float64),
+                np.array([c.maxX-c.minX for c in self.cells],dtype=np.float64),
+                np.array([c.maxY-c.minY for c in self.cells],dtype=np.float64))
+        return self.cellBounds
+
+    def interpolateIds(self, cellIds, offsets):
+        # Batch giveInterpolatedRoute: every hop between non-adjacent cells of
+        # a trajectory is filled with the route cells, the last cell is kept
+        cellIds = np.asarray(cellIds,dtype=np.int64)
+        offsets = np.asarray(offsets,dtype=np.int64)
+        sizes = np.diff(offsets)
+        last = np.zeros(len(cellIds),dtype=bool)
+        last[offsets[1:][sizes > 0]-1] = True
+        filled,counts = self.fillHops(cellIds,last)
+        return filled,np.concatenate(([0],np.cumsum(counts)))[offsets]
+
+    def fillHops(self, cellIds, last):
+        # Diagonal-then-straight: hop k of a route moves both axes towards the
+        # target until one of them is reached, then only the other
+        n = self.getN()
+        ci = cellIds//n
+        cj = cellIds%n
+        di = np.zeros(len(cellIds),dtype=np.int64)
+        dj = np.zeros(len(cellIds),dtype=np.int64)
+        di[:-1] = ci[1:]-ci[:-1]
+        dj[:-1] = cj[1:]-cj[:-1]
+        di[last] = 0
+        dj[last] = 0
+        counts = np.maximum(np.maximum(np.abs(di),np.abs(dj)),1)
+        k = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts,counts)
+        di = np.repeat(di,counts)
+        dj = np.repeat(dj,counts)
+        fi = np.repeat(ci,counts)+np.sign(di)*np.minimum(k,np.abs(di))
+        fj = np.repeat(cj,counts)+np.sign(dj)*np.minimum(k,np.abs(dj))
+        return fi*n+fj,counts
+
+    def stepTowards(self, cellIds, endIds):
+        # Second cell of giveInterpolatedRoute(c,end) for every pair, or end
+        # when the route is a single cell
+        n = self.getN()
+        cellIds = np.asarray(cellIds,dtype=np.int64)
+        endIds = np.asarray(endIds,dtype=np.int64)
+        i = cellIds//n
+        j = cellIds%n
+        return (i+np.sign(endIds//n-i))*n+j+np.sign(endIds%n-j)
+
+    def getCellByIndex(self, i, j):
+        if (i < 0 or j < 0):
+            return None
+        return self.topLevelCells[i][j]
+
     def getXofCell(self, c1):
-        for i in range(len(self.topLevelCells)):
-            for j in range(len(self.topLevelCells)):
-                if(self.topLevelCells[i][j] == c1):
-                    return i+1
-        return -1
+        if (c1 not in self.cellPos):
+            return -1
+        return self.cellPos[c1][0]+1
 
     def getYofCell(self, c1):
-        for i in range(len(self.topLevelCells)):
-            for j in range(len(self.topLevelCells)):
-                if(self.topLevelCells[i][j] == c1):
-                    return j+1
-        return -1
+        if (c1 not in self.cellPos):
+            return -1
+        return self.cellPos[c1][1]+1
     
     def getCells(self) -> List[Cell]:
-        tbR = []
-        for i in range(len(self.topLevelCells)):
-            for j in range(len(self.topLevelCells)):
-                tbR.append(self.topLevelCells[i][j])
-        return tbR
+        return self.cells
+
+    def getCellCount(self):
+        return len(self.cells)
+
+    def getCellById(self, cid):
+        return self.cells[cid]
+
+    def getNeighbourIds(self, cid):
+        return self.neighbourIds[self.neighbourOffsets[cid]:self.neighbourOffsets[cid+1]]
 
     def getPosInListForm(self, c1):
         return self.posInListForm[c1]
@@ -48,105 +251,36 @@ class Grid(object):
         return self.topLevelCells[int(xy[0])][int(xy[1])]
 
     def areAdjacent(self, c1, c2):
-        c1x = -1
-        c1y = -1
-        c2x = -1
-        c2y = 1
-        c1found = False
-        c2found = False
-        for i in range(self.getN()):
-            for j in range(self.getN()):
-                if (c1 == self.topLevelCells[i][j]):
-                    c1x = i
-                    c1y = j
-                    c1found = True
-                if (c2 == self.topLevelCells[i][j]):
-                    c2x = i
-                    c2y = j
-                    c2found = True
-
-        if (c1found == False or c2found == False):
+        if (c1 not in self.cellPos or c2 not in self.cellPos):
             print("cells not found, cannot compute adjacency")
             return False
-        if (c2x == c1x+1 and c2y == c1y):
-            return True
-        if (c2x == c1x+1 and c2y == c1y+1):
-            return True
-        if (c2x == c1x and c2y == c1y+1):
-            return True
-        if (c2x == c1x-1 and c2y == c1y+1):
-            return True
-        if (c2x == c1x-1 and c2y == c1y):
-            return True
-        if (c2x == c1x-1 and c2y == c1y-1):
-            return True
-        if (c2x == c1x and c2y == c1y-1):
-            return True
-        if (c2x == c1x+1 and c2y == c1y-1):
-            return True
-        if (c1x == c2x+1 and c1y == c2y):
-            return True
-        if (c1x == c2x+1 and c1y == c2y+1):
-            return True
-        if (c1x == c2x and c1y == c2y+1):
-            return True
-        if (c1x == c2x-1 and c1y == c2y+1):
-            return True
-        if (c1x == c2x-1 and c1y == c2y):
-            return True
-        if (c1x == c2x-1 and c1y == c2y-1):
-            return True
-        if (c1x == c2x and c1y == c2y-1):
-            return True
-        if (c1x == c2x+1 and c1y == c2y-1):
-            return True
-        return False
+        c1x,c1y = self.cellPos[c1]
+        c2x,c2y = self.cellPos[c2]
+        return max(abs(c1x-c2x),abs(c1y-c2y)) == 1
 
     def getAdjacentCells(self, c1):
-        cells = self.getCells()
-        tbr = []
-        for i in cells:
-            if(self.areAdjacent(i,c1)):
-                tbr.append(i)
-        return tbr
+        if (c1 not in self.posInListForm):
+            print("cells not found, cannot compute adjacency")
+            return []
+        return [self.cells[k] for k in self.getNeighbourIds(self.posInListForm[c1])]
 
     def giveInterpolatedRoute(self, start, end):
-        startx = -1
-        starty = -1
-        endx = -1
-        endy = -1
-        startfound = False
-        endfound = False
-        for i in range(self.getN()):
-            for j in range(self.getN()):
-                if(start == self.topLevelCells[i][j]):
-                    startx = i
-                    starty = j
-                    startfound = True
-                if(end == self.topLevelCells[i][j]):
-                    endx = i
-                    endy = j
-                    endfound = True
-        if(startfound == False or endfound == False):
+        if (start not in self.cellPos or end not in self.cellPos):
             print("Cell Not Found")
             return
+        currx,curry = self.cellPos[start]
+        endx,endy = self.cellPos[end]
         tbr = []
-        currx = startx
-        curry = starty
         while(True):
             tbr.append(self.topLevelCells[currx][curry])
             if(endx > currx):
                 currx += 1
             elif(endx < currx):
                 currx -= 1
-            else:
-                currx = currx
             if(endy > curry):
                 curry += 1
             elif(endy < curry):
                 curry -= 1
-            else:
-                curry = curry
             if(currx == endx and curry == endy):
                 break
         return tbr
@@ -1,6 +1,7 @@
 import overload_function
 from typing import List
 from Trajectory import Trajectory
+from TrajectoryStore import TrajectoryView
 from Grid import Grid
 from Cell import Cell
 class GridTrajectory(object):
@@ -11,27 +12,20 @@ class GridTrajectory(object):
     @__init__.overload
     def __init__(self,t:Trajectory,g:Grid,interpWanted:bool):
         self.trajCells = []
-        gridCells = g.getCells()
-        for i in range(t.getSize()):
-            p = t.getPoint(i)
-            found = False
-            for c in gridCells:
-                if(c.inCell(p)):
-                    self.trajCells.append(c)
-                    found = True
-                    break
-            if(found == False):
-                self.trajCells.append(g.getCellMatrix()[0][0])
-                found = True
+        if(isinstance(t,TrajectoryView)):
+            xs = t.getXs()
+            ys = t.getYs()
+        else:
+            xs = [p.getX() for p in t.getPoints()]
+            ys = [p.getY() for p in t.getPoints()]
+        # Points outside the grid are snapped to the nearest border cell
+        for cid in g.locateIds(xs,ys,True).tolist():
+            self.trajCells.append(g.getCellById(cid))
         newTrajCells = []
         newTrajCells.append(self.trajCells[0])
-        for i in range(1,len(self.trajCells)-1):
-            if(self.trajCells[i] == self.trajCells[len(newTrajCells)-1]):
-                pass
-            else:
+        for i in range(1,len(self.trajCells)):
+            if(self.trajCells[i] != newTrajCells[-1]):
                 newTrajCells.append(self.trajCells[i])
-        if(self.trajCells[len(self.trajCells)-1] != self.trajCells[len(self.trajCells)-2]):
-            newTrajCells.append(self.trajCells[len(self.trajCells)-1])
         if(len(newTrajCells) == 1):
             newTrajCells.append(self.trajCells[len(self.trajCells)-1])
         self.trajCells = newTrajCells
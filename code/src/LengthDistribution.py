@@ -1,6 +1,7 @@
 import scipy.stats as st
 import numpy as np
 import Util
+import Convertor
 import random
 import sys
 from typing import List
@@ -8,39 +9,64 @@ from GridTrajectory import GridTrajectory
 from Grid import Grid
 
 class LengthDistribution(object):
+    # Observed lengths per (start cell, end cell) pair in CSR form: the
+    # lengths of pair pairKeys[k] = start*cellCount+end are
+    # lengths[pairOffsets[k]:pairOffsets[k+1]], capped at 256
     def __init__(self,inputDB:List[GridTrajectory],grid:Grid,eps:float=0):
-        self.lengthCount = {}
+        self.grid = grid
         self.minL = sys.maxsize
         self.maxL = -sys.maxsize
-        count = 0
-        for t in inputDB:
-            name = t.getTrajName()
-            if(t.getLength() > self.maxL):
-                self.maxL = t.getLength()
-            if(t.getLength() < self.minL):
-                self.minL = t.getLength()
-
-            if (name not in self.lengthCount):
-                self.lengthCount[name] = [t.getLength() if t.getLength() < 256 else 256]
-            else:
-                self.lengthCount[name].append(t.getLength() if t.getLength() < 256 else 256)
-            count += 1
-        if (self.maxL > 256):
-            self.maxL = 256
+        if isinstance(inputDB,tuple):
+            cellIds,offsets = inputDB
+        else:
+            cellIds,offsets = Convertor.convertGridTrajToCellIds(inputDB,grid)
+        cellIds = np.asarray(cellIds,dtype=np.int64)
+        sizes = np.diff(offsets)
+        nonEmpty = sizes > 0
+        if (nonEmpty.any()):
+            self.minL = int(sizes[nonEmpty].min())
+            self.maxL = min(int(sizes[nonEmpty].max()),256)
+        keys = cellIds[offsets[:-1][nonEmpty]]*grid.getCellCount()+cellIds[offsets[1:][nonEmpty]-1]
+        self.setLengths(keys,np.minimum(sizes[nonEmpty],256))
         # print("[LengthDistribution]Get Sample Number",count)
 
+    def setLengths(self, keys, lengths):
+        # Groups lengths by pair key, keeping their order within a pair
+        order = np.argsort(keys,kind='stable')
+        self.pairKeys,starts = np.unique(keys[order],return_index=True)
+        self.pairOffsets = np.append(starts,len(order)).astype(np.int64)
+        self.lengths = np.asarray(lengths)[order].astype(np.int16)
+
     def addBias(self,other):
+        # Pairs of other, mapped to this grid by cell name, replace ours
         self.minL = self.minL if self.minL < other.minL else other.minL
         self.maxL = self.maxL if self.maxL > other.maxL else other.maxL
-        lc = other.lengthCount
-        for n,d in lc.items():
-            self.lengthCount[n] = d
+        n = self.grid.getCellCount()
+        m = other.grid.getCellCount()
+        index = Util.mapCellIds(self.grid,other.grid)
+        otherKeys = index[other.pairKeys//m]*n+index[other.pairKeys%m]
+        otherCounts = np.diff(other.pairOffsets)
+        kept = np.repeat(~np.isin(self.pairKeys,otherKeys),np.diff(self.pairOffsets))
+        keys = np.concatenate((np.repeat(self.pairKeys,np.diff(self.pairOffsets))[kept],np.repeat(otherKeys,otherCounts)))
+        self.setLengths(keys,np.concatenate((self.lengths[kept],other.lengths)))
+
+    def sample(self, start, end, rng = np.random):
+        return int(self.sampleBatch([self.grid.getPosInListForm(start)],[self.grid.getPosInListForm(end)],rng)[0])
 
-    def sample(self, start, end):
-        name = start.getName()+"->"+end.getName()
-        if(name not in self.lengthCount):
-            return random.randint(self.minL,self.maxL+1)
-        return self.lengthCount[name][random.randint(0,len(self.lengthCount[name])-1)]
+    def sampleBatch(self, starts, ends, rng = np.random):
+        # One length per (start,end) pair of cell ids; unseen pairs get a
+        # uniform length in [minL,maxL+1]
+        keys = np.asarray(starts,dtype=np.int64)*self.grid.getCellCount()+np.asarray(ends,dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.pairKeys,keys),max(len(self.pairKeys)-1,0))
+        seen = np.zeros(len(keys),dtype=bool)
+        if (len(self.pairKeys) > 0):
+            seen = self.pairKeys[pos] == keys
+        draw = rng.random(len(keys))
+        counts = self.pairOffsets[pos+1]-self.pairOffsets[pos] if len(self.pairKeys) > 0 else np.zeros(len(keys),dtype=np.int64)
+        picked = self.pairOffsets[pos]+np.minimum((draw*counts).astype(np.int64),np.maximum(counts-1,0))
+        observed = self.lengths[np.where(seen,picked,0)] if len(self.lengths) > 0 else np.zeros(len(keys),dtype=np.int64)
+        uniform = self.minL+(draw*(self.maxL+2-self.minL)).astype(np.int64)
+        return np.where(seen,observed,uniform).astype(np.int64)
 
 
 # class LengthDistribution(object):
@@ -2,70 +2,87 @@ from GowallaData import GowallaData
 from Synthesize import SynTraj
 import Convertor
 import time
+import os
+import random
+import Config
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import Util
 from typing import List
 from Evaluation import Evaluation
-from Grid import Grid
 from third.KAnonymity import dls
 from third.PLM.GI.protections.noise import PlanarLaplace
 from LengthDistribution import LengthDistribution
 from StartEndDistribution import StartEndDistribution
 from TimeDistribution import TimeDistribution
+from TrajectoryStore import TrajectoryStore
 
-def ConstructBlockDistribution(db,uidlist:List,cluster:List):
-    interp = True
-    cellCount = 6
+def GroupByCluster(db,uidlist:List,cluster:List):
     clusterDB = {}
-    clusterDistribution = {}
     for i in range(len(uidlist)):
         c = cluster[i]
-        d = db[uidlist[i]]
         if (c in clusterDB):
-            clusterDB[c].extend(d)
+            clusterDB[c].append(db[uidlist[i]])
         else:
-            clusterDB[c] = d
+            clusterDB[c] = [db[uidlist[i]]]
+    for c,d in clusterDB.items():
+        clusterDB[c] = TrajectoryStore.concat(d)
+    return clusterDB
+
+def ConstructBlockDistribution(db,uidlist:List,cluster:List):
+    interp = True
+    clusterDB = GroupByCluster(db,uidlist,cluster)
+    clusterDistribution = {}
     for c,d in clusterDB.items():
-        boundaries = Util.getDataBoundaries(d)
-        minX = boundaries[0]
-        maxX = boundaries[1]
-        minY = boundaries[2]
-        maxY = boundaries[3]
-        grid = Grid(cellCount, minX,maxX,minY,maxY)
-        dbGrid = Convertor.convertTrajToGridTraj(d, grid, interp, 0.05, 0.95)
-        ld = LengthDistribution(dbGrid,grid)
-        sed = StartEndDistribution(dbGrid)
+        grid = Util.getGrid(d)
+        cells = Convertor.convertStoreToCellIds(d,grid,interp)
+        ld = LengthDistribution(cells,grid)
+        sed = StartEndDistribution(cells,grid)
         td = TimeDistribution(d)
         clusterDistribution[c] = [ld,sed,td]
     return clusterDistribution
 
-def ConstructBlockMarkov(db,uidlist:List,cluster:List):
-    interp = True
-    cellCount = 6
-    clusterDB = {}
-    clusterMarkov = {}
-    for i in range(len(uidlist)):
-        c = cluster[i]
-        d = db[uidlist[i]]
-        if (c in clusterDB):
-            clusterDB[c].extend(d)
-        else:
-            clusterDB[c] = d
-    for c,d in clusterDB.items():
-        boundaries = Util.getDataBoundaries(d)
-        minX = boundaries[0]
-        maxX = boundaries[1]
-        minY = boundaries[2]
-        maxY = boundaries[3]
-        grid = Grid(cellCount, minX,maxX,minY,maxY)
-        dbGrid = Convertor.convertTrajToGridTraj(d, grid, interp, 0.05, 0.95)
-        clusterMarkov[c] = Util.extractMarkovProbs(dbGrid,grid)
-    return clusterMarkov
 
+# Cluster models of the pool's synthesis processes, set once per process by
+# initSynWorker instead of being pickled with every task. Only the pool
+# uses it: DoProcess may run in several threads of one process at a time
+synWorkerModels = {}
+
+def initSynWorker(op,bd):
+    synWorkerModels['op'] = op
+    synWorkerModels['bd'] = bd
+
+def synUser(task):
+    return synthesizeUser(task,synWorkerModels['op'],synWorkerModels['bd'])
+
+def synthesizeUser(task,op,bd):
+    # Each user draws from its own seeded generator, so the result does not
+    # depend on which worker runs it and no global random state is touched
+    uid,db,c,seed = task
+    return SynTraj(db,1,op,bd[c],uid,np.random.default_rng(seed))
 
+def SynthesizeUsers(originDB,ulist:List,cluster:List,op,bd,workers:int = None):
+    # SynTraj of every user, in originDB order; workers > 1 fans the users
+    # out to a process pool, 0 uses every core and None Config.SYN_WORKERS
+    baseSeed = Config.SYN_SEED
+    if (baseSeed == None):
+        baseSeed = np.random.SeedSequence().entropy
+    clusterOf = dict(zip(ulist,cluster))
+    uids = list(originDB.keys())
+    tasks = [(uid,originDB[uid],clusterOf[uid],int(np.random.SeedSequence([baseSeed,int(uid)]).generate_state(1)[0])) for uid in uids]
+    if (workers == None):
+        workers = Config.SYN_WORKERS
+    if (workers == 0):
+        workers = os.cpu_count()
+    if (workers <= 1 or len(tasks) <= 1):
+        results = [synthesizeUser(t,op,bd) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers,initializer=initSynWorker,initargs=(op,bd)) as executor:
+            results = list(executor.map(synUser,tasks,chunksize=max(1,len(tasks)//(workers*4))))
+    return dict(zip(uids,results))
 
-def DoProcess(infile,outfile,op=[0,0,0,0]):
+def DoProcess(infile,outfile,op=[0,0,0,0],compression=None,workers=None):
     print("Process Start")
     evanum = 8
     Gowalla = GowallaData()
@@ -74,28 +91,21 @@ def DoProcess(infile,outfile,op=[0,0,0,0]):
     Gowalla.divide_user()
     ulist = Gowalla.getUidlist().tolist()
     cluster = Gowalla.getCluster()
-    originDB = Convertor.convertGowallaToTraj(Gowalla)
-    synDB = {}
+    originDB = Convertor.openTrajDB(infile+'.trajdb',infile)
+    if (originDB == None):
+        originDB = Convertor.convertGowallaToStore(Gowalla)
+        try:
+            Convertor.saveTrajDB(originDB,infile+'.trajdb',infile)
+        except OSError:
+            print("Trajectory database not cached:",infile+'.trajdb')
     evalist = []
     # method 1
     time1 = time.time()
     bd = ConstructBlockDistribution(originDB,ulist,cluster)
-    bm = ConstructBlockMarkov(originDB,ulist,cluster)
-    for uid,db in originDB.items():
-        synDB[uid] = SynTraj(originDB[uid],1,op,bd[cluster[ulist.index(uid)]],bm[cluster[ulist.index(uid)]])
+    synDB = SynthesizeUsers(originDB,ulist,cluster,op,bd,workers)
     time2 = time.time()
-    cOriginDB = {}
-    cSynDB = {}
-    for i in range(len(ulist)):
-        c = cluster[i]
-        d = originDB[ulist[i]]
-        sd = synDB[ulist[i]]
-        if (c in cOriginDB):
-            cOriginDB[c].extend(d)
-            cSynDB[c].extend(sd)
-        else:
-            cOriginDB[c] = d
-            cSynDB[c] = sd
+    cOriginDB = GroupByCluster(originDB,ulist,cluster)
+    cSynDB = GroupByCluster(synDB,ulist,cluster)
     eva = np.array([0.0]*evanum)
     cnt = 0
     for c,d in cOriginDB.items():
@@ -108,16 +118,9 @@ def DoProcess(infile,outfile,op=[0,0,0,0]):
     kresult = K(Gowalla.getGowallaData())
     newG = GowallaData()
     newG.load_from_dfc(kresult)
-    ksynDB = Convertor.convertGowallaToTraj(newG)
+    ksynDB = Convertor.convertGowallaToStore(newG)
     time4 = time.time()
-    cKSynDB = {}
-    for i in range(len(ulist)):
-        c = cluster[i]
-        sd = ksynDB[ulist[i]]
-        if (c in cKSynDB):
-            cKSynDB[c].extend(sd)
-        else:
-            cKSynDB[c] = sd
+    cKSynDB = GroupByCluster(ksynDB,ulist,cluster)
     eva = np.array([0.0]*evanum)
     cnt = 0
     for c,d in cOriginDB.items():
@@ -130,17 +133,10 @@ def DoProcess(infile,outfile,op=[0,0,0,0]):
     presult = PLM(Gowalla.getGowallaData())
     newG = GowallaData()
     newG.load_from_dfc(presult)
-    psynDB = Convertor.convertGowallaToTraj(newG)
+    psynDB = Convertor.convertGowallaToStore(newG)
     psynAllDB = Convertor.convertDbToList(psynDB)
     time6 = time.time()
-    cPSynDB = {}
-    for i in range(len(ulist)):
-        c = cluster[i]
-        sd = psynDB[ulist[i]]
-        if (c in cPSynDB):
-            cPSynDB[c].extend(sd)
-        else:
-            cPSynDB[c] = sd
+    cPSynDB = GroupByCluster(psynDB,ulist,cluster)
     eva = np.array([0.0]*evanum)
     cnt = 0
     for c,d in cOriginDB.items():
@@ -148,16 +144,18 @@ def DoProcess(infile,outfile,op=[0,0,0,0]):
         cnt += 1
     evalist.append(map(lambda x: round(x,6),(eva/cnt).tolist()))
 
-    Convertor.convertTrajToFile(synDB,outfile)
-    Convertor.convertTrajToFile(ksynDB,outfile+'.dls.txt')
-    Convertor.convertTrajToFile(psynDB,outfile+'.plm.txt')
+    suffix = {c:ext for ext,c in Convertor.TRAJFILE_SUFFIXES.items()}.get(compression,'')
+    Convertor.convertTrajToFile(synDB,outfile+suffix,compression)
+    Convertor.convertTrajToFile(ksynDB,outfile+'.dls.txt'+suffix,compression)
+    Convertor.convertTrajToFile(psynDB,outfile+'.plm.txt'+suffix,compression)
     evadfc = pd.DataFrame(evalist)
     evadfc.to_csv(outfile+'.result',index=False)
     print("Process Complete")
 
 def K(kdfc:pd.DataFrame, k=5):
     dfc = kdfc.copy()
-    return dls.dls_pure(dfc,k)
+    # dls iterates rows, which upcasts the compact integer columns to float
+    return dls.dls_pure(dfc,k).astype(kdfc.dtypes.to_dict())
 
 def PLM(pdfc:pd.DataFrame):
     dfc = pdfc.copy()
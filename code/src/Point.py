@@ -1,8 +1,8 @@
-import overload_function
 import math
 
 class Point(object):
-    @overload_function
+    __slots__ = ('time','xCoord','yCoord')
+
     def __init__(self,time,xc,yc):
         self.time = time
         self.xCoord = xc
@@ -0,0 +1,230 @@
+import numpy as np
+import Config
+from Cache import arrayFingerprint
+from Cell import Cell
+from Grid import Grid
+
+class QuadGrid(Grid):
+    # Density-adaptive partition of the bounding box: a node is split into
+    # four quadrants while it holds more than minCount points and is shallower
+    # than maxDepth. The leaves are the cells, numbered in depth-first order
+    # and named by their quadrant path ('q' is the root; 0=(lowX,lowY),
+    # 1=(lowX,highY), 2=(highX,lowY), 3=(highX,highY)). A value on a split
+    # line belongs to the lower quadrant, as in Grid.
+    def __init__(self, minX, maxX, minY, maxY, xs, ys, minCount = None, maxDepth = None):
+        if (minCount == None):
+            minCount = Config.QUADTREE_MIN_COUNT
+        if (maxDepth == None):
+            maxDepth = Config.QUADTREE_MAX_DEPTH
+        self.minX = minX
+        self.maxX = maxX
+        self.minY = minY
+        self.maxY = maxY
+        self.minCount = minCount
+        self.maxDepth = maxDepth
+        self.nodeBounds = []
+        self.nodeChildren = []
+        self.nodeLeaf = []
+        self.nodeNames = []
+        self.cells = []
+        self.cellPos = {}
+        self.posInListForm = {}
+        self.cellDepth = []
+        xs = np.asarray(xs,dtype=np.float64)
+        ys = np.asarray(ys,dtype=np.float64)
+        self.pointsFingerprint = arrayFingerprint([xs,ys])
+        inside = (xs >= minX) & (xs <= maxX) & (ys >= minY) & (ys <= maxY)
+        self.splitNode(minX,maxX,minY,maxY,xs[inside],ys[inside],0,'q')
+        self.nodeChildren = np.array(self.nodeChildren,dtype=np.int64)
+        self.nodeLeaf = np.array(self.nodeLeaf,dtype=np.int64)
+        bounds = np.array(self.nodeBounds,dtype=np.float64)
+        self.nodeMidX = (bounds[:,0]+bounds[:,1])/2
+        self.nodeMidY = (bounds[:,2]+bounds[:,3])/2
+        self.cellBounds = None
+        self.buildNeighbours()
+        self.sampleTable = None
+
+    def splitNode(self, minX, maxX, minY, maxY, xs, ys, depth, name):
+        node = len(self.nodeBounds)
+        self.nodeBounds.append((minX,maxX,minY,maxY))
+        self.nodeChildren.append([-1,-1,-1,-1])
+        self.nodeNames.append(name)
+        if (len(xs) <= self.minCount or depth >= self.maxDepth):
+            c = Cell(minX,minY,maxX-minX,maxY-minY,name)
+            self.nodeLeaf.append(len(self.cells))
+            self.cellPos[c] = node
+            self.posInListForm[c] = len(self.cells)
+            self.cells.append(c)
+            self.cellDepth.append(depth)
+            return node
+        self.nodeLeaf.append(-1)
+        midX = (minX+maxX)/2
+        midY = (minY+maxY)/2
+        quadrant = (xs > midX)*2+(ys > midY)
+        children = [(minX,midX,minY,midY),(minX,midX,midY,maxY),(midX,maxX,minY,midY),(midX,maxX,midY,maxY)]
+        for q in range(4):
+            inQ = quadrant == q
+            self.nodeChildren[node][q] = self.splitNode(*children[q],xs[inQ],ys[inQ],depth+1,name+str(q))
+        return node
+
+    def buildNeighbours(self):
+        # Leaves are adjacent when their closed rectangles touch (edge or
+        # corner); CSR over cell ids plus a -1 padded table, ids ascending
+        minXs,minYs,widths,heights = self.getCellBounds()
+        maxXs = minXs+widths
+        maxYs = minYs+heights
+        n = len(self.cells)
+        rows = []
+        cols = []
+        chunk = 1024
+        for first in range(0,n,chunk):
+            last = min(first+chunk,n)
+            touch = ((minXs[first:last,None] <= maxXs[None,:]) & (minXs[None,:] <= maxXs[first:last,None]) &
+                (minYs[first:last,None] <= maxYs[None,:]) & (minYs[None,:] <= maxYs[first:last,None]))
+            touch[np.arange(last-first),np.arange(first,last)] = False
+            r,c = np.nonzero(touch)
+            rows.append(r+first)
+            cols.append(c)
+        rows = np.concatenate(rows)
+        self.neighbourIds = np.concatenate(cols).astype(np.int64)
+        degree = np.bincount(rows,minlength=n)
+        self.neighbourOffsets = np.concatenate(([0],np.cumsum(degree))).astype(np.int64)
+        table = np.full((n,max(int(degree.max()),1)),-1,dtype=np.int64)
+        table[rows,np.arange(len(rows))-self.neighbourOffsets[rows]] = self.neighbourIds
+        self.neighbourTable = table
+
+    def getKey(self):
+        return ('quadtree',self.minX,self.maxX,self.minY,self.maxY,self.minCount,self.maxDepth,self.pointsFingerprint)
+
+    def getN(self):
+        return len(self.cells)
+
+    def getDepth(self, c1):
+        return self.cellDepth[self.posInListForm[c1]]
+
+    # Leaves of different depths have no (i,j) position or cell matrix;
+    # cells are addressed by id (getCellById, locateId) or by name
+    def getCellByIndex(self, i, j):
+        raise TypeError("QuadGrid cells have no (i,j) index, use getCellById or getCellByName")
+
+    def getXofCell(self, c1):
+        raise TypeError("QuadGrid cells have no column, use getPosInListForm or getCellBounds")
+
+    def getYofCell(self, c1):
+        raise TypeError("QuadGrid cells have no row, use getPosInListForm or getCellBounds")
+
+    def getCellMatrix(self):
+        raise TypeError("QuadGrid has no cell matrix, use getCells")
+
+    def locateBatch(self, xs, ys, clip:bool = False):
+        raise TypeError("QuadGrid cells have no (i,j) index, use locateIds")
+
+    def descend(self, nodes, xs, ys):
+        # Walks every point from its node down to the leaf containing it
+        for _ in range(self.maxDepth+1):
+            children = self.nodeChildren[nodes]
+            internal = children[:,0] >= 0
+            if (not internal.any()):
+                break
+            quadrant = (xs > self.nodeMidX[nodes])*2+(ys > self.nodeMidY[nodes])
+            nodes = np.where(internal,children[np.arange(len(nodes)),quadrant],nodes)
+        return nodes
+
+    def locate(self, x, y):
+        # Cell id of the point, -1 outside the grid
+        return self.locateId(x,y)
+
+    def locateId(self, x, y):
+        if (not (x >= self.minX and x <= self.maxX and y >= self.minY and y <= self.maxY)):
+            return -1
+        node = 0
+        while (self.nodeChildren[node][0] >= 0):
+            node = self.nodeChildren[node][int(x > self.nodeMidX[node])*2+int(y > self.nodeMidY[node])]
+        return int(self.nodeLeaf[node])
+
+    def locateIds(self, xs, ys, clip:bool = False):
+        xs = np.asarray(xs,dtype=np.float64)
+        ys = np.asarray(ys,dtype=np.float64)
+        outside = ~((xs >= self.minX) & (xs <= self.maxX) & (ys >= self.minY) & (ys <= self.maxY))
+        xs = np.clip(xs,self.minX,self.maxX)
+        ys = np.clip(ys,self.minY,self.maxY)
+        ids = self.nodeLeaf[self.descend(np.zeros(len(xs),dtype=np.int64),xs,ys)]
+        if (not clip):
+            ids[outside] = -1
+        return ids
+
+    def getCentre(self, c1):
+        return ((c1.minX+c1.maxX)/2,(c1.minY+c1.maxY)/2)
+
+    def getCellByName(self, name:str):
+        # Names from another QuadGrid (e.g. the cluster grid behind the
+        # block distributions) are followed as far as this tree goes; a path
+        # that stops at an internal node maps to the leaf at its centre
+        node = 0
+        for q in name[1:]:
+            if (self.nodeChildren[node][0] < 0):
+                break
+            node = self.nodeChildren[node][int(q)]
+        if (self.nodeChildren[node][0] >= 0):
+            node = self.descend(np.array([node]),self.nodeMidX[[node]],self.nodeMidY[[node]])[0]
+        return self.cells[self.nodeLeaf[node]]
+
+    def areAdjacent(self, c1, c2):
+        if (c1 not in self.posInListForm or c2 not in self.posInListForm):
+            print("cells not found, cannot compute adjacency")
+            return False
+        neighbours = self.getNeighbourIds(self.posInListForm[c1])
+        return bool((neighbours == self.posInListForm[c2]).any())
+
+    def fillHops(self, cellIds, last):
+        # Routes are not arithmetic here, so only the non-adjacent hops are
+        # walked one by one
+        nextIds = np.append(cellIds[1:],-1)
+        gap = ~last & (nextIds != cellIds)
+        gap[gap] = ~(self.neighbourTable[cellIds[gap]] == nextIds[gap][:,None]).any(axis=1)
+        counts = np.ones(len(cellIds),dtype=np.int64)
+        pieces = []
+        prev = 0
+        for i in np.nonzero(gap)[0].tolist():
+            route = self.routeIds(int(cellIds[i]),int(nextIds[i]))
+            pieces.append(cellIds[prev:i])
+            pieces.append(route)
+            counts[i] = len(route)
+            prev = i+1
+        pieces.append(cellIds[prev:])
+        return np.concatenate(pieces),counts
+
+    def stepTowards(self, cellIds, endIds):
+        tbr = np.asarray(endIds,dtype=np.int64).copy()
+        for k,(c,e) in enumerate(zip(np.asarray(cellIds).tolist(),tbr.tolist())):
+            route = self.routeIds(c,e)
+            if (len(route) > 1):
+                tbr[k] = route[1]
+        return tbr
+
+    def giveInterpolatedRoute(self, start, end):
+        if (start not in self.posInListForm or end not in self.posInListForm):
+            print("Cell Not Found")
+            return
+        return [self.cells[k] for k in self.routeIds(self.posInListForm[start],self.posInListForm[end]).tolist()]
+
+    def routeIds(self, startId, endId):
+        # Leaves crossed by the segment between the two cell centres, sampled
+        # at a fraction of the smallest leaf; like Grid the end is excluded
+        if (startId == endId):
+            return np.array([startId],dtype=np.int64)
+        x0,y0 = self.getCentre(self.cells[startId])
+        x1,y1 = self.getCentre(self.cells[endId])
+        _,_,widths,heights = self.getCellBounds()
+        sides = np.concatenate((widths,heights))
+        sides = sides[sides > 0]
+        steps = 1
+        if (len(sides) > 0):
+            steps = max(int(np.ceil(np.hypot(x1-x0,y1-y0)/(sides.min()/8))),1)
+        ts = np.linspace(0,1,steps+1)
+        ids = self.locateIds(x0+(x1-x0)*ts,y0+(y1-y0)*ts,True)
+        ids = ids[np.concatenate(([True],ids[1:] != ids[:-1]))]
+        reached = np.nonzero(ids == endId)[0]
+        if (len(reached) > 0):
+            ids = ids[:reached[0]]
+        return ids
@@ -1,6 +1,8 @@
 import random
 import math
+import numpy as np
 from Trajectory import Trajectory
+from TrajectoryStore import TrajectoryStore
 from typing import List
 
 class Query(object):
@@ -32,12 +34,34 @@ class Query(object):
         return False
 
     def evaluateQueryOnDatabase(self,dataset:List[Trajectory]):
+        if isinstance(dataset,TrajectoryStore):
+            return self.evaluateQueryOnStore(dataset)
         tbr = 0
         for  t in dataset:
             if (self.evaluateQueryOnTraj(t) == True):
                 tbr += 1
         return tbr
-        
+
+    def evaluateQueryOnStore(self,store:TrajectoryStore):
+        if (store.getPointCount() < 2):
+            return 0
+        x1 = store.xs[:-1]
+        x2 = store.xs[1:]
+        y1 = store.ys[:-1]
+        y2 = store.ys[1:]
+        inner = np.ones(len(x1),dtype=bool)
+        hops = store.offsets[1:-1]-store.offsets[0]-1
+        inner[hops[(hops >= 0) & (hops < len(x1))]] = False
+        near1 = np.hypot(x1-self.centerX,y1-self.centerY) <= self.radius
+        near2 = np.hypot(x2-self.centerX,y2-self.centerY) <= self.radius
+        dx = x2-x1
+        dy = y2-y1
+        same = (dx == 0) & (dy == 0)
+        u = ((self.centerX-x1)*dx+(self.centerY-y1)*dy)/np.where(same,1,dx*dx+dy*dy)
+        u = np.clip(u,0,1)
+        onSegment = np.hypot(x1+u*dx-self.centerX,y1+u*dy-self.centerY) <= self.radius
+        hit = inner & (near1 | near2 | same | onSegment)
+        return len(np.unique(store.getTrajectoryIndex()[:-1][hit]))
 
     def eucDistance(self,p1x,p1y,p2x,p2y):
         return math.sqrt((p2x-p1x)*(p2x-p1x) + (p2y-p1y)*(p2y-p1y))
@@ -1,29 +1,43 @@
 import scipy.stats as st
 import numpy as np
 import Util
+import Convertor
 import random
 import sys
 from typing import List
 from GridTrajectory import GridTrajectory
 from Cell import Cell
+from Grid import Grid
 
 class StartEndDistribution(object):
-    def __init__(self,inputDB:List[GridTrajectory]):
-        self.startCount = []
-        self.endCount = []
-        count = 0
-        for t in inputDB:
-            cells = t.getCells()
-            self.startCount.append(cells[0].toString())
-            self.endCount.append(cells[-1].toString())
-            count += 1 
+    # Number of trajectories starting and ending in every cell of the grid,
+    # with running sums for sampling
+    def __init__(self,inputDB:List[GridTrajectory],grid:Grid):
+        self.grid = grid
+        if isinstance(inputDB,tuple):
+            cellIds,offsets = inputDB
+        else:
+            cellIds,offsets = Convertor.convertGridTrajToCellIds(inputDB,grid)
+        nonEmpty = np.diff(offsets) > 0
+        n = grid.getCellCount()
+        self.setCounts(np.bincount(cellIds[offsets[:-1][nonEmpty]],minlength=n),np.bincount(cellIds[offsets[1:][nonEmpty]-1],minlength=n))
         # print("[StartEndDistribution]Get Sample Number",count)
 
+    def setCounts(self, startCount, endCount):
+        self.startCount = np.asarray(startCount,dtype=np.int64)
+        self.endCount = np.asarray(endCount,dtype=np.int64)
+        self.startCumsum = np.cumsum(self.startCount)
+        self.endCumsum = np.cumsum(self.endCount)
+
     def addBias(self,other):
-        self.startCount = other.startCount
-        self.endCount = other.endCount
+        # The counts of other replace ours, moved to this grid by cell name
+        index = Util.mapCellIds(self.grid,other.grid)
+        n = self.grid.getCellCount()
+        self.setCounts(np.bincount(index,weights=other.startCount,minlength=n),np.bincount(index,weights=other.endCount,minlength=n))
 
-    def sample(self):
-        start = self.startCount[random.randint(0,len(self.startCount)-1)]
-        end = self.endCount[random.randint(0,len(self.endCount)-1)]
-        return [start,end]
\ No newline at end of file
+    def sample(self, n:int = 1, rng = np.random):
+        # n start and n end cell ids, drawn independently in proportion to
+        # the counts
+        starts = np.searchsorted(self.startCumsum,rng.random(n)*self.startCumsum[-1],'right')
+        ends = np.searchsorted(self.endCumsum,rng.random(n)*self.endCumsum[-1],'right')
+        return starts.astype(np.int64),ends.astype(np.int64)
@@ -1,64 +1,116 @@
 from typing import List
 from Trajectory import Trajectory
 from Grid import Grid
-from GridTrajectory import GridTrajectory
 from LengthDistribution import LengthDistribution
 from TimeDistribution import TimeDistribution
 from StartEndDistribution import StartEndDistribution
 from GowallaData import GowallaData
 import Util
+import copy
+import numpy as np
+import Config
 import Convertor
+from TrajectoryStore import TrajectoryStore
+from Cache import modelCache, arrayBytes
 
-def SynTraj(originalDB:List[Trajectory], totalEpsilon:float, options:List,blockDistribution,blockMarkov) -> List[Trajectory]:
+class SynModel(object):
+    # What SynTraj learns from one user's trajectories before any block
+    # bias is applied; plain arrays and distributions, so it pickles
+    def __init__(self, grid, markov, ld:LengthDistribution, sed:StartEndDistribution, td:TimeDistribution, count:int):
+        self.grid = grid
+        self.markov = markov
+        self.ld = ld
+        self.sed = sed
+        self.td = td
+        self.count = count
+
+def BuildSynModel(originalDB:List[Trajectory], uid = None) -> SynModel:
+    # Cached by (uid, data hash, grid parameters); the options and block
+    # models only enter in SynFromModel
     interp = True
-    cellCount = 6
-    budgetDistnWeights = [0.05,0.35,0.50,0.10]
-    boundaries = Util.getDataBoundaries(originalDB)
-    minX = boundaries[0]
-    maxX = boundaries[1]
-    minY = boundaries[2]
-    maxY = boundaries[3]
-    grid = Grid(cellCount, minX,maxX,minY,maxY)
-    dbGrid = Convertor.convertTrajToGridTraj(originalDB, grid, interp)
-    markovTransitionProbs = Util.extractMarkovProbs(dbGrid,grid)
-    lengthDistribution = LengthDistribution(dbGrid,grid)
+    store = TrajectoryStore.fromTrajectories(originalDB)
+    key = (uid,store.getFingerprint(),interp,Config.GRID_TYPE,Config.CELL_COUNT,Config.QUADTREE_MIN_COUNT,Config.QUADTREE_MAX_DEPTH)
+    model = modelCache.get(key)
+    if (model != None):
+        return model
+    grid = Util.getGrid(store)
+    cells = Convertor.convertStoreToCellIds(store,grid,interp)
+    markovTransitionProbs = Util.extractMarkovProbs(cells,grid)
+    model = SynModel(grid,markovTransitionProbs,LengthDistribution(cells,grid),StartEndDistribution(cells,grid),TimeDistribution(store),len(store))
+    # Rough footprint: the matrix plus a few words per point
+    return modelCache.put(key,model,arrayBytes(markovTransitionProbs)+32*store.getPointCount())
+
+def SynFromModel(model:SynModel, options:List, blockDistribution, rng = np.random) -> TrajectoryStore:
+    # The distributions are copied before addBias so the cached model is
+    # left untouched. The walk always uses the user's own Markov model;
+    # options[3] is kept for the option layout but has no block counterpart
+    lengthDistribution = model.ld
     if (options[0] == 0):
+        lengthDistribution = copy.copy(model.ld)
         lengthDistribution.addBias(blockDistribution[0])
-    startendDistribution = StartEndDistribution(dbGrid)
+    startendDistribution = model.sed
     if (options[1] == 0):
+        startendDistribution = copy.copy(model.sed)
         startendDistribution.addBias(blockDistribution[1])
-    timeDistribution = TimeDistribution(originalDB)
+    timeDistribution = model.td
     if (options[2] == 0):
+        timeDistribution = copy.copy(model.td)
         timeDistribution.addBias(blockDistribution[2])
-    if (options[3] == 0):
-        Util.perturbationMarkov(markovTransitionProbs,blockMarkov)
-    synGridDB = DoSynTraj(grid,markovTransitionProbs,timeDistribution,startendDistribution,lengthDistribution,len(originalDB))
-    synDB = Convertor.convertGridTrajToTraj(synGridDB,timeDistribution)
-    return synDB
+    cellIds,offsets = DoSynTrajBatch(model.grid,model.markov,startendDistribution,lengthDistribution,model.count,rng)
+    return Convertor.convertCellIdsToTraj(cellIds,offsets,timeDistribution,model.grid,rng)
+
+def SynTraj(originalDB:List[Trajectory], totalEpsilon:float, options:List,blockDistribution,uid = None,rng = np.random) -> TrajectoryStore:
+    budgetDistnWeights = [0.05,0.35,0.50,0.10]
+    return SynFromModel(BuildSynModel(originalDB,uid),options,blockDistribution,rng)
 
 
-def DoSynTraj(g,markovProbs,td:TimeDistribution,sed:StartEndDistribution,ld:LengthDistribution,desired:int):
-    tbr = []
-    # transitionMatrices = [[0]*len(markovProbs) for _ in range(len(markovProbs))]
-    transitionMatrices = Util.precomputeMarkov(markovProbs,256)
-    for cnt in range(desired):
-        se = sed.sample()
-        startCell = g.getCellByName(se[0])
-        endCell = g.getCellByName(se[1])
-        length = ld.sample(startCell,endCell)
-        newTrajCells = [0]*length
-        newTrajCells[0] = startCell
-        newTrajCells[-1] = endCell
-        for i in range(1,length-1):
-            prevCell = newTrajCells[i-1]
-            eventualCell = newTrajCells[-1]
-            stepToEventual = length-i-1
-            step1matrix = transitionMatrices[1]
-            stepNmatrix = transitionMatrices[stepToEventual]
-            newTrajCells[i] = Util.findWithMarkov(prevCell,eventualCell,step1matrix,stepNmatrix,g)
-        sTraj = GridTrajectory(newTrajCells)
-        tbr.append(sTraj)
-    return tbr
+def DoSynTrajBatch(g,markovProbs,sed:StartEndDistribution,ld:LengthDistribution,desired:int,rng = np.random):
+    # Synthesizes desired trajectories at once. Walks are advanced together
+    # by the number of steps left to their end cell, so every round uses
+    # one pair of Markov powers; returns flat cell ids and offsets
+    transitionMatrices = Util.getMarkovPowers(markovProbs)
+    starts,ends = sed.sample(desired,rng)
+    lengths = np.maximum(ld.sampleBatch(starts,ends,rng),1)
+    offsets = np.concatenate(([0],np.cumsum(lengths))).astype(np.int64)
+    cellIds = np.zeros(offsets[-1],dtype=np.int64)
+    cellIds[offsets[:-1]] = starts
+    cellIds[offsets[1:]-1] = ends
+    table = g.neighbourTable
+    step1matrix = transitionMatrices[1]
+    maxRemaining = int(lengths.max())-2
+    if (maxRemaining < 1):
+        return cellIds,offsets
+    # Walks are run in groups of end cells small enough for the columns
+    # A^k[:,ends] of a group to fit the Markov memory budget
+    uniqueEnds = np.unique(ends)
+    chunk = transitionMatrices.getEndChunk(maxRemaining)
+    for first in range(0,len(uniqueEnds),chunk):
+        chunkEnds = uniqueEnds[first:first+chunk]
+        chunkWalks = np.nonzero(np.isin(ends,chunkEnds))[0]
+        # Longest walks first, so the walks still running are a prefix
+        byLength = chunkWalks[np.argsort(-lengths[chunkWalks],kind='stable')]
+        sortedLengths = -lengths[byLength]
+        for remaining,stepN in transitionMatrices.descendingColumns(chunkEnds,maxRemaining):
+            walks = byLength[:np.searchsorted(sortedLengths,-(remaining+2),side='right')]
+            if (len(walks) == 0):
+                continue
+            positions = offsets[walks]+lengths[walks]-1-remaining
+            prev = cellIds[positions-1]
+            end = ends[walks]
+            endColumn = np.searchsorted(chunkEnds,end)
+            candidates = table[prev]
+            valid = candidates >= 0
+            safe = np.where(valid,candidates,0)
+            probs = np.where(valid,step1matrix[prev[:,None],safe]*stepN[safe,endColumn[:,None]],0)
+            cumulative = np.cumsum(probs,axis=1)
+            total = cumulative[:,-1]
+            chosen = (cumulative < (rng.random(len(walks))*total)[:,None]).sum(axis=1)
+            nextIds = safe[np.arange(len(walks)),np.minimum(chosen,table.shape[1]-1)]
+            stuck = ~(total > 0)
+            if (stuck.any()):
+                nextIds[stuck] = g.stepTowards(prev[stuck],end[stuck])
+            cellIds[positions] = nextIds
+    return cellIds,offsets
 
 
 if __name__ == "__main__":
@@ -4,12 +4,22 @@ import random
 import sys
 from typing import List
 from Trajectory import Trajectory
+from TrajectoryStore import TrajectoryStore
 from Point import Point
 
 class TimeDistribution(object):
+    # Observed timestamps per step index, one contiguous int64 array per step
     def __init__(self,inputDB:List[Trajectory]):
         self.timeCount = {}
         count = 0
+        if isinstance(inputDB,TrajectoryStore):
+            steps = inputDB.getStepIndex()
+            order = np.argsort(steps,kind='stable')
+            stepValues,stepStarts = np.unique(steps[order],return_index=True)
+            times = np.split(inputDB.times[order],stepStarts[1:])
+            for i in range(len(stepValues)):
+                self.timeCount[int(stepValues[i])] = np.ascontiguousarray(times[i],dtype=np.int64)
+            return
         for t in inputDB:
             size = t.getSize()
             for i in range(size):
@@ -19,9 +29,14 @@ class TimeDistribution(object):
                 else:
                     self.timeCount[i].append(p.getTime())
                 count += 1
+        for s,t in self.timeCount.items():
+            self.timeCount[s] = np.array(t,dtype=np.int64)
         # print("[TimeDistribution]Get Sample Number",count)
 
     def addBias(self,other):
+        # The dictionary is copied since it may belong to a cached model; the
+        # arrays of other are shared, never written to
+        self.timeCount = dict(self.timeCount)
         tc = other.timeCount
         for s,t in tc.items():
             self.timeCount[s] = t
@@ -29,5 +44,23 @@ class TimeDistribution(object):
     def sample(self, step:int):
         if (step not in self.timeCount):
             for s,t in self.timeCount.items():
-                return t[random.randint(0,len(t)-1)]
-        return self.timeCount[step][random.randint(0,len(self.timeCount[step])-1)]
\ No newline at end of file
+                return int(t[random.randint(0,len(t)-1)])
+        return int(self.timeCount[step][random.randint(0,len(self.timeCount[step])-1)])
+
+    def sampleBatch(self, steps, rng = np.random):
+        # One timestamp per step index, drawn like sample(); unseen steps use
+        # the first step's times
+        steps = np.asarray(steps,dtype=np.int64)
+        tbr = np.zeros(len(steps),dtype=np.int64)
+        if (len(steps) == 0):
+            return tbr
+        fallback = next(iter(self.timeCount.values()))
+        draws = rng.random(len(steps))
+        values,inverse = np.unique(steps,return_inverse=True)
+        order = np.argsort(inverse.reshape(-1),kind='stable')
+        groups = np.split(order,np.cumsum(np.bincount(inverse.reshape(-1)))[:-1])
+        for k,s in enumerate(values.tolist()):
+            rows = groups[k]
+            t = self.timeCount.get(s,fallback)
+            tbr[rows] = t[(draws[rows]*len(t)).astype(np.int64)]
+        return tbr
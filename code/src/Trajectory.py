@@ -1,4 +1,5 @@
 import overload_function
+import Diameter
 from Point import Point
 from Cell import Cell
 
@@ -63,15 +64,7 @@ class Trajectory(object):
         return currMin
 
     def getDiameter(self):
-        maxDist = 0
-        for i in range(self.getSize()):
-            for j in range(self.getSize()):
-                p1 = self.points[i]
-                p2 = self.points[j]
-                dist = p1.euclideanDistTo(p2)
-                if(dist > maxDist):
-                    maxDist = dist
-        return maxDist
+        return Diameter.diameter([p.getX() for p in self.points],[p.getY() for p in self.points])
 
     def getDistanceTravelled(self):
         tbr = 0
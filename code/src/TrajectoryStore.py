@@ -0,0 +1,181 @@
+import numpy as np
+import Diameter
+from Cache import arrayFingerprint
+from Point import Point
+from Trajectory import Trajectory
+
+class TrajectoryStore(object):
+    # Columnar trajectory database: point i of trajectory k lives at
+    # offsets[k]+i in the flat xs/ys/times arrays
+    def __init__(self, xs, ys, times, offsets):
+        self.xs = np.asarray(xs,dtype=np.float64)
+        self.ys = np.asarray(ys,dtype=np.float64)
+        self.times = np.asarray(times,dtype=np.int64)
+        self.offsets = np.asarray(offsets,dtype=np.int64)
+        self.fingerprint = None
+
+    @staticmethod
+    def fromTrajectories(db):
+        if isinstance(db,TrajectoryStore):
+            return db
+        xs = []
+        ys = []
+        times = []
+        offsets = [0]
+        for t in db:
+            for p in t.getPoints():
+                xs.append(p.getX())
+                ys.append(p.getY())
+                times.append(p.getTime())
+            offsets.append(len(xs))
+        return TrajectoryStore(xs,ys,times,offsets)
+
+    @staticmethod
+    def concat(dbs):
+        stores = [TrajectoryStore.fromTrajectories(d) for d in dbs]
+        if (len(stores) == 1):
+            return stores[0]
+        if (len(stores) == 0):
+            return TrajectoryStore([],[],[],[0])
+        offsets = [np.zeros(1,dtype=np.int64)]
+        base = 0
+        for s in stores:
+            offsets.append(s.offsets[1:]-s.offsets[0]+base)
+            base += s.getPointCount()
+        xs = np.concatenate([s.xs for s in stores])
+        ys = np.concatenate([s.ys for s in stores])
+        times = np.concatenate([s.times for s in stores])
+        return TrajectoryStore(xs,ys,times,np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield TrajectoryView(self,i)
+
+    def __getitem__(self, pos):
+        if isinstance(pos,slice):
+            start,stop,step = pos.indices(len(self))
+            if (step != 1):
+                raise IndexError("TrajectoryStore only supports contiguous slices")
+            return self.slice(start,stop)
+        if (pos < 0):
+            pos += len(self)
+        if (pos < 0 or pos >= len(self)):
+            raise IndexError("trajectory index out of range")
+        return TrajectoryView(self,pos)
+
+    def slice(self, start, stop):
+        # Shares the coordinate arrays with this store
+        stop = max(start,stop)
+        first = self.offsets[start]-self.offsets[0]
+        last = self.offsets[stop]-self.offsets[0]
+        return TrajectoryStore(self.xs[first:last],self.ys[first:last],self.times[first:last],self.offsets[start:stop+1]-self.offsets[start])
+
+    def getPointCount(self):
+        return int(self.offsets[-1]-self.offsets[0])
+
+    def getSizes(self):
+        return np.diff(self.offsets)
+
+    def getTrajectoryIndex(self):
+        return np.repeat(np.arange(len(self)),self.getSizes())
+
+    def getStepIndex(self):
+        return np.arange(self.getPointCount())-np.repeat(self.offsets[:-1]-self.offsets[0],self.getSizes())
+
+    def getFingerprint(self):
+        # Identity of the trajectories' contents, equal for equal data
+        if (self.fingerprint == None):
+            self.fingerprint = arrayFingerprint([self.xs,self.ys,self.times,self.offsets-self.offsets[0]])
+        return self.fingerprint
+
+    def getBoundaries(self):
+        return [self.xs.min(),self.xs.max(),self.ys.min(),self.ys.max()]
+
+    def getDistancesTravelled(self):
+        tbr = np.zeros(len(self))
+        if (self.getPointCount() < 2):
+            return tbr
+        steps = np.hypot(np.diff(self.xs),np.diff(self.ys))
+        # Drop the hops between the last point of one trajectory and the first of the next
+        hops = self.offsets[1:-1]-self.offsets[0]-1
+        steps[hops[(hops >= 0) & (hops < len(steps))]] = 0
+        sizes = self.getSizes()
+        nonEmpty = sizes > 0
+        starts = (self.offsets[:-1]-self.offsets[0])[nonEmpty]
+        tbr[nonEmpty] = np.add.reduceat(np.append(steps,0),starts)
+        return tbr
+
+    def getDiameters(self):
+        return Diameter.diameters(self.xs,self.ys,self.offsets-self.offsets[0])
+
+    def toTrajectories(self):
+        tbr = []
+        for v in self:
+            t = Trajectory()
+            t.points = v.getPoints()
+            tbr.append(t)
+        return tbr
+
+
+class TrajectoryView(Trajectory):
+    def __init__(self, store:TrajectoryStore, pos:int):
+        self.store = store
+        self.start = store.offsets[pos]-store.offsets[0]
+        self.end = store.offsets[pos+1]-store.offsets[0]
+
+    @property
+    def points(self):
+        return self.getPoints()
+
+    def getXs(self):
+        return self.store.xs[self.start:self.end]
+
+    def getYs(self):
+        return self.store.ys[self.start:self.end]
+
+    def getTimes(self):
+        return self.store.times[self.start:self.end]
+
+    def getSize(self):
+        return int(self.end-self.start)
+
+    def getPoint(self, pos):
+        if (pos < 0):
+            pos += self.getSize()
+        if (pos < 0 or pos >= self.getSize()):
+            raise IndexError("point index out of range")
+        i = self.start+pos
+        return Point(int(self.store.times[i]),float(self.store.xs[i]),float(self.store.ys[i]))
+
+    def getPoints(self):
+        xs = self.getXs().tolist()
+        ys = self.getYs().tolist()
+        times = self.getTimes().tolist()
+        return [Point(times[i],xs[i],ys[i]) for i in range(len(xs))]
+
+    def addCoordinates(self, xc, yc, time):
+        raise TypeError("TrajectoryView is read-only")
+
+    def addPoint(self, p):
+        raise TypeError("TrajectoryView is read-only")
+
+    def getMinXCoord(self):
+        return self.getXs().min()
+
+    def getMinYCoord(self):
+        return self.getYs().min()
+
+    def getMaxXCoord(self):
+        return self.getXs().max()
+
+    def getMaxYCoord(self):
+        return self.getYs().max()
+
+    def getDiameter(self):
+        return Diameter.diameter(self.getXs(),self.getYs())
+
+    def getDistanceTravelled(self):
+        return float(np.hypot(np.diff(self.getXs()),np.diff(self.getYs())).sum())
@@ -1,14 +1,21 @@
 from typing import List
 from Trajectory import Trajectory
+from TrajectoryStore import TrajectoryStore
 from GridTrajectory import GridTrajectory
 from Grid import Grid
-from Cell import Cell
+from QuadGrid import QuadGrid
 import random
 import numpy as np
+import scipy.sparse as sp
 import hashlib
 import time
+import Config
+import Convertor
+from Cache import gridCache, markovCache, arrayFingerprint, arrayBytes
 
 def getDataBoundaries(db:List[Trajectory]):
+    if isinstance(db,TrajectoryStore):
+        return db.getBoundaries()
     dataMinX = float('inf')
     dataMinY = float('inf')
     dataMaxX = float('-inf')
@@ -29,88 +36,188 @@ def getDataBoundaries(db:List[Trajectory]):
     tbr.append(dataMaxY)
     return tbr
 
-def extractMarkovProbs(origDBgrid:List[GridTrajectory],g:Grid,privacyBudget=1) -> List[List[float]]:
-    cells = g.getCells()
-    actualCounts = [[0]*len(cells) for _ in range(len(cells))]
-    for gt in origDBgrid:
-        trajCells = gt.getCells()
-        for i in range(len(trajCells)-1):
-            thisCell = trajCells[i]
-            nextCell = trajCells[i+1]
-            thisCellIndex = cells.index(thisCell)
-            nextCellIndex = cells.index(nextCell)
-            actualCounts[thisCellIndex][nextCellIndex] = actualCounts[thisCellIndex][nextCellIndex]+1/(len(trajCells)-1)
-    
-    return actualCounts
-
-def perturbationMarkov(markov,bmarkov):
-    ma = np.array(markov)
-    ba = np.array(bmarkov)
-    tbr = ba-0.1*ma
-    return tbr.tolist()
+def makeGrid(db, cellCount:int = None, gridType:str = None):
+    # None picks Config.CELL_COUNT / Config.GRID_TYPE at call time
+    if (cellCount == None):
+        cellCount = Config.CELL_COUNT
+    if (gridType == None):
+        gridType = Config.GRID_TYPE
+    boundaries = getDataBoundaries(db)
+    minX = boundaries[0]
+    maxX = boundaries[1]
+    minY = boundaries[2]
+    maxY = boundaries[3]
+    if (gridType == 'quadtree'):
+        store = TrajectoryStore.fromTrajectories(db)
+        return QuadGrid(minX,maxX,minY,maxY,store.xs,store.ys)
+    return Grid(cellCount,minX,maxX,minY,maxY)
+
+def getGrid(db, cellCount:int = None, gridType:str = None):
+    # makeGrid through the process-wide cache. The grid is shared, so callers
+    # that divideFurther must use makeGrid instead
+    if (cellCount == None):
+        cellCount = Config.CELL_COUNT
+    if (gridType == None):
+        gridType = Config.GRID_TYPE
+    key = ('grid',gridType,tuple(float(b) for b in getDataBoundaries(db)))
+    if (gridType == 'quadtree'):
+        key += (TrajectoryStore.fromTrajectories(db).getFingerprint(),)
+    else:
+        key += (cellCount,)
+    g = gridCache.get(key)
+    if (g == None):
+        g = makeGrid(db,cellCount,gridType)
+        # Rough footprint: neighbour tables plus the cell objects
+        gridCache.put(key,g,2*g.neighbourTable.nbytes+1024*g.getCellCount())
+    return g
+
+def extractMarkovProbs(origDBgrid:List[GridTrajectory],g:Grid,privacyBudget=1):
+    # Transition counts between cells, each trajectory weighted 1/(len-1);
+    # origDBgrid is a list of GridTrajectory or the (cellIds,offsets) pair
+    # of Convertor.convertStoreToCellIds
+    if isinstance(origDBgrid,tuple):
+        cellIds,offsets = origDBgrid
+    else:
+        cellIds,offsets = Convertor.convertGridTrajToCellIds(origDBgrid,g)
+    n = g.getCellCount()
+    cellIds = np.asarray(cellIds,dtype=np.int64)
+    sizes = np.diff(offsets)
+    if (len(cellIds) < 2):
+        return sp.csr_matrix((n,n))
+    weights = np.repeat(1/np.maximum(sizes-1,1),sizes)
+    # A trajectory's last cell has no successor
+    hasNext = np.ones(len(cellIds),dtype=bool)
+    hasNext[offsets[1:][sizes > 0]-1] = False
+    hasNext = hasNext[:-1]
+    # Sparse: transitions only ever join adjacent cells; duplicates are summed
+    counts = sp.csr_matrix((weights[:-1][hasNext],(cellIds[:-1][hasNext],cellIds[1:][hasNext])),shape=(n,n))
+    counts.sort_indices()
+    return counts
+
+def mapCellIds(g:Grid, target:Grid):
+    # Id in g of the cell of every target cell, matched by cell name
+    return np.array([g.getPosInListForm(g.getCellByName(c.getName())) for c in target.getCells()],dtype=np.int64)
 
 def printGridTraj(gdTraj):
     for i in gdTraj:
         print("["+i.getName()+"]->",end="")
     print("")
 
-def findWithMarkov(prevCell:Cell, eventualCell:Cell, step1matrix, stepNmatrix, g:Grid):
-    candidateCells = g.getAdjacentCells(prevCell)
-    candidateProbs = []*len(candidateCells)
-    for i in range(len(candidateProbs)):
-        thisCandidate = candidateCells[i]
-        row = g.getPosInListForm(prevCell)
-        col = g.getPosInListForm(thisCandidate)
-        prob1 = step1matrix[row][col]
-        row = g.getPosInListForm(thisCandidate)
-        col = g.getPosInListForm(eventualCell)
-        prob2 = stepNmatrix[row][col]
-        candProb = prob1*prob2
-        candidateProbs[i] = candProb
-    sump = 0
-    for i in range(len(candidateProbs)):
-        sump += candidateProbs[i]
-    if (sump < 0.00001):
-        directRoute = g.giveInterpolatedRoute(prevCell,eventualCell)
-        if (len(directRoute) > 1):
-            return directRoute[1]
+class MarkovPowers(object):
+    # Powers of a one-step transition matrix A. powers[1] is A itself and
+    # powers[k] builds A^k column block by column block; walks use
+    # descendingColumns, which only computes the columns of their end cells.
+    # Every column is rescaled to a maximum of 1 so long walks neither
+    # overflow nor underflow; callers only compare entries within one
+    # column of one power. Up to MARKOV_DENSE_CELLS cells A is a dense
+    # array, above that a sparse matrix and powers[k] a SparseMarkovPower.
+    # Nothing is modified after construction, so threads can share one
+    # instance
+    def __init__(self, oneStep, maxBytes:int = None):
+        if (maxBytes == None):
+            maxBytes = Config.MARKOV_POWER_BYTES
+        oneStep = sp.csr_matrix(oneStep,dtype=np.float64)
+        oneStep.sum_duplicates()
+        oneStep.sort_indices()
+        self.n = oneStep.shape[0]
+        self.dense = self.n <= Config.MARKOV_DENSE_CELLS
+        self.maxBytes = maxBytes
+        if (self.dense):
+            self.oneStep = rescale(oneStep.toarray())
+            self.oneStepColumns = self.oneStep
         else:
-            return eventualCell
-    normalizedProb = []
-    for p in candidateProbs:
-        normalizedProb.append(p/sump)
-    randomVal = random.random()
-    seenSoFar = 0
-    for i in range(len(candidateProbs)):
-        seenSoFar += normalizedProb[i]
-        if (seenSoFar >= randomVal):
-            return candidateCells[i]
-    # Should have returned before here
-    directRoute = g.giveInterpolatedRoute(prevCell,eventualCell)
-    if (len(directRoute) > 1):
-        return directRoute[1]
-    else:
-        return eventualCell
-
-def precomputeMarkov(oneStep,maxSteps):
-    tbr = [oneStep,oneStep]
-    for i in range(2,maxSteps+1):
-        prevStep = tbr[i-1]
-        currStep = matrixMultiply(prevStep,oneStep)
-        tbr.append(currStep)
-    return tbr
+            self.oneStep = oneStep
+            self.oneStepColumns = oneStep.tocsc()
+            # Row-major keys of the stored entries, for gathering by searchsorted
+            self.keys = np.repeat(np.arange(self.n,dtype=np.int64),np.diff(oneStep.indptr))*self.n+oneStep.indices
+
+    def __getitem__(self, k):
+        k = max(int(k),1)
+        if (not self.dense):
+            return SparseMarkovPower(self,k)
+        if (k == 1):
+            return self.oneStep
+        return next(self.descendingColumns(np.arange(self.n),k))[1]
+
+    def entries(self, rows, cols):
+        # One-step entries of the sparse matrix at (rows[i],cols[i])
+        keys = rows*self.n+cols
+        if (len(self.keys) == 0):
+            return np.zeros(keys.shape)
+        pos = np.minimum(np.searchsorted(self.keys,keys),len(self.keys)-1)
+        return np.where(self.keys[pos] == keys,self.oneStep.data[pos],0)
+
+    def getEndChunk(self, maxK:int):
+        # Number of end columns descendingColumns can keep within budget
+        vectors = 2*(int(np.sqrt(maxK))+1)
+        return max(1,self.maxBytes//(8*self.n*vectors))
+
+    def descendingColumns(self, ends, maxK:int):
+        # (k, A^k[:,ends]) for k = maxK..1, each column rescaled. The powers
+        # go up once keeping every stride-th block and recompute the blocks
+        # in between on the way down: 2*maxK products of A with an n x
+        # len(ends) block, sqrt(maxK) blocks in memory
+        ends = np.asarray(ends,dtype=np.int64)
+        stride = max(1,int(np.sqrt(maxK)))
+        columns = self.oneStepColumns[:,ends]
+        columns = rescaleColumns(columns if self.dense else columns.toarray())
+        checkpoints = [columns]
+        for k in range(2,maxK+1):
+            columns = rescaleColumns(self.oneStep @ columns)
+            if ((k-1)%stride == 0):
+                checkpoints.append(columns)
+        for c in range(len(checkpoints)-1,-1,-1):
+            base = c*stride+1
+            block = [checkpoints[c]]
+            for k in range(base+1,min(base+stride,maxK+1)):
+                block.append(rescaleColumns(self.oneStep @ block[-1]))
+            for i in range(len(block)-1,-1,-1):
+                yield base+i,block[i]
+
+class SparseMarkovPower(object):
+    # powers[k] of a sparse MarkovPowers, indexed like a dense array with a
+    # (rows,cols) pair of broadcastable index arrays; k > 1 computes the
+    # columns asked for through descendingColumns
+    def __init__(self, powers:MarkovPowers, k:int):
+        self.powers = powers
+        self.k = k
+
+    def __getitem__(self, index):
+        rows,cols = np.broadcast_arrays(np.asarray(index[0],dtype=np.int64),np.asarray(index[1],dtype=np.int64))
+        if (self.k == 1):
+            return self.powers.entries(rows,cols)
+        uniqueCols,inverse = np.unique(cols.reshape(-1),return_inverse=True)
+        if (len(uniqueCols) == 0):
+            return np.zeros(rows.shape)
+        _,columns = next(self.powers.descendingColumns(uniqueCols,self.k))
+        return columns[rows.reshape(-1),inverse.reshape(-1)].reshape(rows.shape)
+
+def rescale(m):
+    top = np.abs(m).max() if m.size > 0 else 0
+    if (top > 0 and np.isfinite(top)):
+        return m/top
+    return m
+
+def rescaleColumns(m):
+    top = np.abs(m).max(axis=0) if m.shape[0] > 0 else np.zeros(m.shape[1])
+    top[~(top > 0) | ~np.isfinite(top)] = 1
+    return m/top
 
-def matrixMultiply(a,b):
-    am = np.mat(a)
-    bm = np.mat(b)
-    c = am*bm
-    return c.tolist()
-    # c = [[0]*len(b[0]) for _ in range(len(a))]
-    # for i in range(len(a)):
-    #     for j in range(len(b[0])):
-    #         for k in range(len(a[0])):
-    #             c[i][j] += a[i][k]*b[k][j]
-    # return c
+def getMarkovPowers(oneStep):
+    # Users with the same transition matrix share one MarkovPowers, charged
+    # for its copies of the one-step matrix
+    oneStep = sp.csr_matrix(oneStep,dtype=np.float64)
+    oneStep.sum_duplicates()
+    oneStep.sort_indices()
+    key = arrayFingerprint([oneStep.data,oneStep.indices,oneStep.indptr,np.array(oneStep.shape)])
+    powers = markovCache.get(key)
+    if (powers == None):
+        powers = MarkovPowers(oneStep)
+        nbytes = arrayBytes(powers.oneStep)
+        if (not powers.dense):
+            nbytes = 2*nbytes+powers.keys.nbytes
+        powers = markovCache.put(key,powers,nbytes)
+    return powers
 
 def md5Time():
     m = hashlib.md5()
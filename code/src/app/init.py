@@ -42,7 +42,7 @@ def index():
         fname = upload + m.hexdigest() + '.txt'
         rname = process + m.hexdigest() + '.txt'
         f.save(fname)
-        threading.Thread(target=MainProcess.DoProcess,args=(fname,rname,op)).start()
+        threading.Thread(target=MainProcess.DoProcess,args=(fname,rname,op,'gzip')).start()
         # _thread.start_new_thread(MainProcess.DoProcess,(fname,rname,op))
         return redirect('/result?id='+m.hexdigest())
     return render_template('index.html')
@@ -54,7 +54,7 @@ def result():
         return redirect('/')
     base_path = path.abspath(path.dirname(__file__))
     process = path.join(base_path,'processed/')
-    if (os.path.exists(process+rid+'.txt')):
+    if (os.path.exists(process+rid+'.txt.result')):
         r = open(process+rid+'.txt.result')
         fcsv = csv.reader(r)
         rlist = []
@@ -74,6 +74,8 @@ def download():
         return redirect('/')
     base_path = path.abspath(path.dirname(__file__))
     process = path.join(base_path,'processed/')
+    if (os.path.exists(process+fid+".txt.gz")):
+        return send_file(process+fid+".txt.gz",as_attachment=True)
     if (os.path.exists(process+fid+".txt")):
         return send_file(process+fid+".txt",as_attachment=True)
     return redirect('/')
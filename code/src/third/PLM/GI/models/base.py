@@ -5,8 +5,6 @@ from typing import Type
 from typing import Union
 from pickle import dump, load
 
-from math import sqrt
-
 from GI.models.database import Database
 from GI.models.tools import CoordinatesConverter, Spatial
 
@@ -219,15 +217,7 @@ class Trajectory:
         :return: float
         """
 
-        diameter = 0
-        for i in range(len(self.checkins)):
-            for j in range(i + 1, len(self.checkins)):
-                # squared Euclidean distance
-                dist = Spatial.sqeuclidean(self.checkins[i].location.coordinates(),
-                                           self.checkins[j].location.coordinates())
-                if dist > diameter:
-                    diameter = dist
-        return sqrt(diameter)
+        return Spatial.diameter(self.coordinates())
 
     def length(self) -> float:
         """
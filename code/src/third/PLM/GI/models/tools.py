@@ -6,6 +6,10 @@ from jenkspy import jenks_breaks
 from math import atan, degrees, exp, log, pi, radians, tan, sqrt
 
 
+# number of positions up to which Spatial.diameter compares all pairs instead of using the convex hull
+DIAMETER_PAIRWISE_MAX = 64
+
+
 class ArrayConverter:
     @staticmethod
     def dict2list(d, ordered_keys: tuple) -> list:
@@ -145,6 +149,52 @@ class Spatial:
 
         return sum((coordinate1 - coordinate2) ** 2 for coordinate1, coordinate2 in zip(position1, position2))
 
+    @staticmethod
+    def diameter(positions: tuple, pairwise_max: int = DIAMETER_PAIRWISE_MAX) -> float:
+        """
+        Calculate the largest Euclidean distance between two of the 2D positions.
+        Up to pairwise_max positions all pairs are compared at once; larger inputs use the convex hull (monotone
+        chain) and rotating calipers over its antipodal vertex pairs.
+        :param positions: tuple, a tuple of 2D positions
+        :param pairwise_max: int, the largest number of positions whose pairs are all compared
+        :return: float, diameter
+        """
+
+        points = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        if len(points) < 2:
+            return 0
+        if len(points) <= pairwise_max:
+            diff = points[:, None, :] - points[None, :, :]
+            return sqrt(float((diff ** 2).sum(axis=2).max()))
+
+        def cross(o, a, b):
+            return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+        # turns smaller than this (relative to the extent of the points) count as straight
+        eps = 1e-12 * float((points.max(axis=0) - points.min(axis=0)).max()) ** 2
+
+        def half(chain_points):
+            chain = []
+            for p in chain_points:
+                while len(chain) >= 2 and cross(chain[-2], chain[-1], p) <= eps:
+                    chain.pop()
+                chain.append(p)
+            return chain
+
+        ordered = [tuple(p) for p in points[np.lexsort((points[:, 1], points[:, 0]))].tolist()]
+        hull = half(ordered)[:-1] + half(reversed(ordered))[:-1]
+        if len(hull) < 3:
+            return Spatial.euclidean(hull[0], hull[-1]) if hull else 0
+
+        h = len(hull)
+        best, j = 0, 1
+        for i in range(h):
+            ni = (i + 1) % h
+            while abs(cross(hull[i], hull[ni], hull[(j + 1) % h])) > abs(cross(hull[i], hull[ni], hull[j])):
+                j = (j + 1) % h
+            best = max(best, Spatial.sqeuclidean(hull[i], hull[j]), Spatial.sqeuclidean(hull[ni], hull[j]))
+        return sqrt(best)
+
     @staticmethod
     def perpendicular(position1: tuple, position2: tuple, position3: tuple) -> float:
         """
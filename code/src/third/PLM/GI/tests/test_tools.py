@@ -1,8 +1,12 @@
 # encoding=utf-8
 import unittest
+from itertools import combinations
+from math import sqrt
 
-from GI.protections.noise import CoordinatesConverter
-from GI.models.tools import DatasetImporter
+import numpy as np
+
+from GI.models.base import Dataset
+from GI.models.tools import CoordinatesConverter, Spatial, DIAMETER_PAIRWISE_MAX
 
 
 class TestCoordinatesConverter(unittest.TestCase):
@@ -54,11 +58,53 @@ class TestCoordinatesConverter(unittest.TestCase):
             self.assertAlmostEqual(i, j, delta=0.001)
 
 
+class TestSpatial(unittest.TestCase):
+    @staticmethod
+    def brute_force_diameter(positions: tuple) -> float:
+        return max((Spatial.euclidean(p, q) for p, q in combinations(positions, 2)), default=0)
+
+    def assert_diameter(self, xs, ys):
+        positions = tuple(zip(np.asarray(xs, dtype=float).tolist(), np.asarray(ys, dtype=float).tolist()))
+        expected = self.brute_force_diameter(positions)
+        for pairwise_max in (DIAMETER_PAIRWISE_MAX, 2):
+            self.assertAlmostEqual(Spatial.diameter(positions, pairwise_max), expected, delta=1e-9 * max(expected, 1))
+
+    def test_diameter(self):
+        random = np.random.RandomState(0)
+        # sizes on both sides of DIAMETER_PAIRWISE_MAX, each also run through the convex hull
+        for n in (0, 1, 2, 3, 10, DIAMETER_PAIRWISE_MAX, DIAMETER_PAIRWISE_MAX + 1, 300):
+            xs = random.uniform(-1000, 1000, n)
+            # random
+            self.assert_diameter(xs, random.uniform(-1000, 1000, n))
+            # collinear
+            self.assert_diameter(xs, 3 * xs + 7)
+            self.assert_diameter(np.full(n, 5.0), xs)
+            # duplicate points on a small lattice
+            self.assert_diameter(random.randint(0, 4, n), random.randint(0, 4, n))
+            # a circle
+            angles = random.uniform(0, 2 * np.pi, n)
+            self.assert_diameter(10 + 50 * np.cos(angles), -20 + 50 * np.sin(angles))
+
+    def test_diameter_nearly_collinear(self):
+        # rounding makes points on a line turn slightly left or right, which the hull must not mistake for corners
+        random = np.random.RandomState(1)
+        for _ in range(50):
+            xs = random.rand(300)
+            self.assert_diameter(xs, 3 * xs)
+            self.assert_diameter(xs, -1.7 * xs + 0.3)
+
+    def test_diameter_known(self):
+        self.assertEqual(Spatial.diameter(()), 0)
+        self.assertEqual(Spatial.diameter(((1, 1),) * 100), 0)
+        square = tuple((x, y) for x in range(10) for y in range(10))
+        self.assertAlmostEqual(Spatial.diameter(square), sqrt(2) * 9, delta=1e-9)
+
+
 class TestDatasetImporter(unittest.TestCase):
     def test_load_adatrace_dataset(self):
         dataset_directory = 'D:\\Workspace\\IWorkspace\\AdaTrace\\'
         wrong_actual_dataset_filepath = dataset_directory + 'wrong_brinkhoff.dat'
-        self.assertRaises(OSError, DatasetImporter.import_from_adatrace, wrong_actual_dataset_filepath)
+        self.assertRaises(OSError, Dataset.import_from_adatrace, wrong_actual_dataset_filepath)
 
 
 if __name__ == '__main__':